@@ -1,29 +1,52 @@
-from PySide6.QtCore import QObject, QThread, Slot, Signal, QIODevice
+from PySide6.QtCore import QTimer, Slot, QIODevice
 from PySide6.QtSerialPort import QSerialPort
+from antenna_worker import AntennaWorker
+import collections
+import math
 import re
+import time
 
-class Antenna_1_2(QObject):
-    onRssiReceived = Signal(str, str)
-    onRssiReadError = Signal()
+# Answer of the receiver to a frequency change, e.g. b"#RSSI 123\r\n"
+RSSI_PATTERN = re.compile(rb'#RSSI\s+(\d+)')
 
-    rssi_answer = ''
-    currentFrequency = None
-
-    def __init__(self, comPort):
-        super().__init__()
+# Longest line that is accepted, anything longer is line noise
+MAX_LINE_LENGTH = 256
 
-        self.comPort = comPort
+class Antenna_1_2(AntennaWorker):
+    currentFrequency = None
+    # Seconds a #SET waits for its #RSSI reply before it is given up
+    replyTimeout = 1.0
+
+    def __init__(self, comPort, settleTime=None):
+        super().__init__(comPort, settleTime)
+
+        # Received bytes that don't form a complete line yet
+        self.rxBuffer = bytearray()
+        # Frequency to set once the command in flight is written
+        self.pendingFrequency = None
+        # Frequency sets replaced by a newer one before being written
+        self.droppedWrites = 0
+        # When the UART is done shifting out the last command
+        self.linkIdleTime = 0.0
+        # Tunes whose #RSSI reply has not arrived yet, oldest first
+        self.awaitingReply = collections.deque()
 
     def setupComPort(self):
-        self.comportThread = QThread()
-        self.comportThread.moveToThread(self.comportThread)
-        self.comportThread.start()
-
-        self.serial = QSerialPort()
+        # Created here so they belong to the I/O thread
+        self.serial = QSerialPort(self)
         self.serial.readyRead.connect(self.onReadyRead)
+        self.serial.bytesWritten.connect(self.onBytesWritten)
+
+        self.flushTimer = QTimer(self)
+        self.flushTimer.setSingleShot(True)
+        self.flushTimer.timeout.connect(self.flushPendingFrequency)
 
         self.openPort()
 
+    def closePort(self):
+        self.flushTimer.stop()
+        self.serial.close()
+
 
     def openPort(self):
         if self.serial.isOpen():
@@ -33,38 +56,123 @@ class Antenna_1_2(QObject):
         self.serial.setDataBits(QSerialPort.DataBits.Data8)
         self.serial.setParity(QSerialPort.Parity.NoParity)
         self.serial.setStopBits(QSerialPort.StopBits.OneStop)
-        self.serial.open(QIODevice.ReadWrite)
+        if not self.serial.open(QIODevice.ReadWrite):
+            raise RuntimeError(self.serial.errorString())
 
 
     @Slot()
     def onReadyRead(self):
-        finalRssiLinePart = '\n'
-
-        rx = self.serial.readLine()
-
-        try:
-            rxstring = rx.data().decode("utf-8")
-            self.rssi_answer += rxstring
-            if finalRssiLinePart in rxstring:
-                rssi = self.extractValueFromRssiAnswer(self.rssi_answer)
-                self.onRssiReceived.emit(self.currentFrequency, rssi)
-                self.rssi_answer = ''
-        except:
+        # Take everything that arrived, there can be several lines
+        timestamp = time.monotonic()
+        self.rxBuffer += self.serial.readAll().data()
+
+        end = self.rxBuffer.rfind(b'\n')
+        if end < 0:
+            if len(self.rxBuffer) > MAX_LINE_LENGTH:
+                self.rxBuffer.clear()
+                self.onRssiReadError.emit()
+            return
+
+        lines = self.rxBuffer[:end].split(b'\n')
+        # Keep the partial line for the next call
+        del self.rxBuffer[:end + 1]
+
+        for line in lines:
+            self.onLineReceived(line, timestamp)
+
+    def onLineReceived(self, line, timestamp):
+        if not line.strip():
+            return
+        rssi = self.extractValueFromRssiAnswer(line)
+        if rssi is None:
             self.onRssiReadError.emit()
+            return
+        # A reply to a #SET belongs to that tune, the receiver answers
+        # once it has measured. Only other lines need the settle window
+        # to be attributed to the tune they were measured at.
+        tune = self.replyTune(timestamp)
+        if tune is None:
+            tune = self.tuneAt(timestamp)
+        if tune is None:
+            self.unsettledReadings += 1
+            return
+        self.onRssiReceived.emit(tune.frequency, rssi, timestamp)
+
+    def replyTune(self, timestamp):
+        # The oldest tune still waiting for its reply, replies come in
+        # the order of the commands
+        while self.awaitingReply and timestamp - self.awaitingReply[0].sentAt > self.replyTimeout:
+            self.awaitingReply.popleft()
+        if not self.awaitingReply:
+            return None
+        return self.awaitingReply.popleft()
 
     @Slot(str)
     def setAntennaFrequency(self, frequency):
-        if self.serial.isOpen():
-            if self.currentFrequency == frequency:
-                return
-            data = f'#SET {frequency}'
-            txs = ','.join(map(str, data)) + '\n'
-            self.serial.write(txs.encode())
-            self.currentFrequency = frequency
+        if not self.serial.isOpen():
+            return
+
+        # While a command is still going out, only remember the latest
+        # frequency so the antenna follows the operator without working
+        # through a backlog
+        if self.isLinkBusy():
+            if self.pendingFrequency is not None:
+                self.droppedWrites += 1
+            if frequency == self.currentFrequency:
+                self.pendingFrequency = None
+            else:
+                self.pendingFrequency = frequency
+            return
+
+        if self.currentFrequency == frequency:
+            return
+        self.writeFrequency(frequency)
+
+    def summary(self):
+        return f'{super().summary()}, {self.droppedWrites} frequency writes coalesced'
+
+    def isLinkBusy(self):
+        # Bytes still in Qt's buffer, or in the OS buffer on their way out
+        return (self.serial.bytesToWrite() > 0
+                or time.monotonic() < self.linkIdleTime)
+
+    @Slot(int)
+    def onBytesWritten(self, count):
+        self.flushPendingFrequency()
 
-
-    def extractValueFromRssiAnswer(self, rssi):
-        m = re.match(".* (\d+)", rssi) # expecting "#RSSI 123"
-        return m.group(1)
+    @Slot()
+    def flushPendingFrequency(self):
+        if self.pendingFrequency is None:
+            return
+        if self.isLinkBusy():
+            # Coarse timers can fire a bit early, try again when it's idle
+            if not self.flushTimer.isActive():
+                self.flushTimer.start(
+                    math.ceil(1000 * (self.linkIdleTime - time.monotonic())))
+            return
+        frequency = self.pendingFrequency
+        self.pendingFrequency = None
+        if frequency != self.currentFrequency:
+            self.writeFrequency(frequency)
+
+    def writeFrequency(self, frequency):
+        data = f'#SET {frequency}'
+        txs = ','.join(map(str, data)) + '\n'
+        tx = txs.encode()
+        self.serial.write(tx)
+        self.currentFrequency = frequency
+
+        # 10 bits per byte: start bit, 8 data bits, stop bit
+        wireTime = 10 * len(tx) / self.serial.baudRate()
+        self.linkIdleTime = time.monotonic() + wireTime
+        self.awaitingReply.append(self.beginTune(frequency, self.linkIdleTime))
+        self.flushTimer.start(math.ceil(1000 * wireTime))
+
+
+    def extractValueFromRssiAnswer(self, line):
+        m = RSSI_PATTERN.search(line) # expecting b"#RSSI 123"
+        if m is None:
+            return None
+        return m.group(1).decode('ascii')
 
 
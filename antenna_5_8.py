@@ -1,56 +1,226 @@
-from PySide6.QtCore import QObject, QThread, Slot, Signal
-from tbs_fusion import TBSFusion
+from PySide6.QtCore import QTimer, Slot
+from antenna_worker import AntennaWorker, reduceRssi, settleTimeFromConfig
+from tbs_fusion import sweep_duration
+from tbs_fusion_bus import FusionBus
+from tbs_fusion_trace import TraceRecorder
+import threading
 import time
 
-class Antenna_5_8(QObject):
-    onRssiReceived = Signal(str, str)
-    onRssiReadError = Signal()
+def asRange(frequencies):
+    # Evenly spaced frequencies as a range, so they are measured with
+    # range scans (up to 255 per request instead of 126)
+    if isinstance(frequencies, range) or len(frequencies) < 2:
+        return frequencies
+    step = frequencies[1] - frequencies[0]
+    if step <= 0 or any(b - a != step for a, b in zip(frequencies, frequencies[1:])):
+        return frequencies
+    return range(frequencies[0], frequencies[-1] + step, step)
 
-    def __init__(self, comPort):
-        super().__init__()
+class Antenna_5_8(AntennaWorker):
 
-        self.comPort = comPort
+    def __init__(self, comPort, address=1, rssiStreamRate=2.0, rssiStreamAverage=4,
+                 settleTime=None, sweepDelayMs=None, rssiMode='stream', rssiReadsPerTune=4,
+                 traceFile=None):
+        super().__init__(comPort, settleTime)
 
+        self.address = address  # "Serial Addr" in the receiver settings
+        # 'stream': sample the RSSI continuously, 'tune': one reading
+        # after each tune, averaged from rssiReadsPerTune reads
+        self.rssiMode = rssiMode
+        self.rssiReadsPerTune = rssiReadsPerTune
+        self.rssiStreamRate = rssiStreamRate  # RSSI samples per second
+        self.rssiStreamAverage = rssiStreamAverage  # Readings per sample
+        self.sweepDelayMs = sweepDelayMs  # Settle time per sweep frequency
+        # Latest sweep request not measured yet, see sweepFrequencies
+        self.pendingSweep = None
+        self.traceFile = traceFile  # Raw protocol trace is saved here on close
+        self.bus = None
 
-    def setupComPort(self):
-        self.comportThread = QThread()
-        self.comportThread.moveToThread(self.comportThread)
-        self.comportThread.start()
+        self.rssiStreamThread = None
+        self.rssiStreamStop = threading.Event()
+
+    @classmethod
+    def fromConfig(cls, config):
+        return cls(config["comPort"],
+                   config.get("antennaAddress", 1),
+                   config.get("rssiStreamRate", 2.0),
+                   config.get("rssiStreamAverage", 4),
+                   settleTimeFromConfig(config),
+                   config.get("sweepDelayMs"),
+                   config.get("rssiMode", 'stream'),
+                   config.get("rssiReadsPerTune", 4),
+                   config.get("traceFile"))
 
-        self.fusion = TBSFusion(
+    def setupComPort(self):
+        # Receivers on the same RS-485 adapter share one bus
+        self.bus = FusionBus.acquire(
             self.comPort,  # Serial port to use
             baudrate=9600,  # Baudrate ("Serial Baud" in settings)
-            default_address=1,  # Address ("Serial Addr" in settings)
+            timeout=0.5,  # Response timeout in seconds
             discard_echo=False,  # Set to False for RS-485
+            # Raw protocol trace, see traceFile. Receivers on the same
+            # port share the recorder of the first one, self.bus.trace
+            trace=TraceRecorder(),
         )
+        self.fusion = self.bus.device(self.address)
+
+        if self.rssiMode == 'stream':
+            self.startRssiStream(self.rssiStreamRate, self.rssiStreamAverage)
+
+    def closePort(self):
+        self.stopRssiStream()
+        if self.bus is not None:
+            if self.traceFile:
+                self.dumpTrace(self.traceFile)
+            self.bus.release()
+            self.bus = None
+
+    def dumpTrace(self, path):
+        # Decode with: python tbs_fusion_trace.py <path>
+        try:
+            self.bus.trace.dump(path)
+        except OSError as e:
+            self.onCommandError.emit(f'Failed to save the protocol trace to {path}: {e}')
 
     @Slot(str)
     def setAntennaFrequency(self, frequency):
-        # Set the operating frequency
-        self.fusion.set_frequency(int(frequency))
+        # Set the operating frequency, blocks the I/O thread only.
+        # Recorded before sending, the stream can read the new frequency
+        # before set_frequency() returns.
+        tune = self.beginTune(frequency, time.monotonic())
+        try:
+            self.fusion.set_frequency(int(frequency))
+        except (RuntimeError, OSError) as e:
+            self.onCommandError.emit(f'Failed to set frequency {frequency}: {e}')
+            return
+
+        if self.rssiMode == 'tune':
+            # Read the RSSI once it has settled, without blocking the
+            # I/O thread in the meantime
+            settleMs = max(0, round(1000 * (tune.settledAt - time.monotonic())))
+            QTimer.singleShot(settleMs, self, lambda: self.sampleTune(tune))
+
+    def sampleTune(self, tune):
+        # Skip tunes that were replaced by a newer one while settling
+        if not self.tunes or self.tunes[-1] is not tune:
+            return
+
+        reads = []
+        try:
+            for _ in range(self.rssiReadsPerTune):
+                frequency, rssi_a, rssi_b = self.fusion.get_frequency_rssi()
+                if frequency == int(tune.frequency):
+                    reads.append((rssi_a, rssi_b))
+        except (RuntimeError, OSError):
+            self.onRssiReadError.emit()
+            return
+
+        if not reads:
+            self.unsettledReadings += 1
+            return
+        self.emitReading(reduceRssi(tune.frequency, reads, time.monotonic(), tune.sequence))
+
+    @Slot(object)
+    def sweepFrequencies(self, frequencies):
+        # Requests that arrive while a sweep is measured replace each
+        # other, only the latest one is measured next
+        isScheduled = self.pendingSweep is not None
+        self.pendingSweep = frequencies
+        if not isScheduled:
+            QTimer.singleShot(0, self, self.runPendingSweep)
+
+    def sweepDuration(self, frequencies):
+        # Same request as runPendingSweep, both receivers
+        return sweep_duration(asRange(frequencies), 0, self.sweepDelayMs)
+
+    def runPendingSweep(self):
+        frequencies = self.pendingSweep
+        self.pendingSweep = None
+
+        # The receiver measures the whole list by itself
+        try:
+            scan = self.fusion.rssi_sweep(asRange(frequencies), delay_ms=self.sweepDelayMs)
+        except (RuntimeError, OSError, ValueError) as e:
+            self.onCommandError.emit(f'Sweep failed: {e}')
+            self.onSweepReceived.emit([], time.monotonic())
+        else:
+            pairs = [(str(f), '%0.2f' % rssi)
+                     for f, rssi in zip(scan.frequencies, scan.scaled())]
+            self.onSweepReceived.emit(pairs, time.monotonic())
+
+        # The sweep leaves the receiver on its last frequency, go back
+        # to the one the station is tuned to
+        if self.tunes:
+            self.setAntennaFrequency(self.tunes[-1].frequency)
+
+    def startRssiStream(self, rate=2.0, average=4):
+        # Poll the RSSI on a background thread, the signals are queued
+        # to the receivers' thread so the UI never waits for the port
+        self.stopRssiStream()
+        self.rssiStreamStop.clear()
+        self.rssiStreamThread = threading.Thread(
+            target=self.runRssiStream, args=(rate, average), daemon=True,
+            name=f'RSSI stream {self.comPort}:{self.address}')
+        self.rssiStreamThread.start()
+
+    def stopRssiStream(self):
+        if self.rssiStreamThread is None:
+            return
+        self.rssiStreamStop.set()
+        self.rssiStreamThread.join()
+        self.rssiStreamThread = None
+
+    def runRssiStream(self, rate, average):
+        while not self.rssiStreamStop.is_set():
+            # The readings of a sample are taken after the previous one
+            # was yielded
+            sampleStart = time.monotonic()
+            try:
+                for timestamp, frequency, rssi_a, rssi_b in self.fusion.stream_rssi(
+                        rate, average, self.rssiStreamStop):
+                    if self.isSampleSettled(sampleStart, timestamp, frequency):
+                        # Every sample is the mean of average reads
+                        self.emitRssi(frequency, rssi_a, rssi_b, timestamp, average)
+                    else:
+                        self.unsettledReadings += 1
+                    sampleStart = time.monotonic()
+            except (RuntimeError, OSError):
+                self.onRssiReadError.emit()
+                # Don't flood the UI while the receiver is unreachable
+                self.rssiStreamStop.wait(1.0)
 
-        # Wait for RSSI to stabilize
-        # time.sleep(1)
-        # self.getFrequencyRssi()
+    def isSampleSettled(self, sampleStart, sampleEnd, frequency):
+        # All readings of the sample must belong to one settled tune of
+        # the frequency the receiver reports
+        if not self.tunes:
+            return True
+        tune = self.tuneAt(sampleStart)
+        return (tune is not None and self.tuneAt(sampleEnd) is tune
+                and int(tune.frequency) == frequency)
 
+    def emitRssi(self, frequency, rssi_a, rssi_b, timestamp, numReads=1):
+        tune = self.tuneAt(timestamp)
+        self.emitReading(reduceRssi(str(frequency), [(rssi_a, rssi_b)], timestamp,
+                                    tune.sequence if tune else None, numReads))
 
+    def emitReading(self, reading):
+        # The string signal carries the diversity-combined value, the
+        # better of the two receivers like a single antenna reports it
+        self.onRssiReading.emit(reading)
+        self.onRssiReceived.emit(reading.frequency, '%0.2f' % reading.diversity,
+                                 reading.timestamp)
 
     def getFrequencyRssi(self):
-        # Get the frequency and print the RSSI
-        freq_received, rssi_a, rssi_b = self.fusion.get_frequency_rssi()
-        print('Frequency: %d MHz RSSI A: %0.2f RSSI B: %0.2f'
-              % (freq_received, rssi_a, rssi_b))
-        print(f'freq_received type: {type(freq_received)}')
-        print(f'rssi_a type: {type(rssi_a)}')
-        print(f'rssi_b type: {type(rssi_b)}')
-        self.onRssiReceived.emit(freq_received, rssi_a)
+        # Read the RSSI once
+        frequency, rssi_a, rssi_b = self.fusion.get_frequency_rssi()
+        self.emitRssi(frequency, rssi_a, rssi_b, time.monotonic())
 
         '''
         # Perform an RSSI scan in the "F" band
-        freqs, rssi = fusion.rssi_scan_range(5740, 5900, 20)
-        print(' '.join(['%d MHz: %0.2f' % (f, r) for f, r in zip(freqs, rssi)]))
+        scan = fusion.rssi_scan_range(5740, 5900, 20)
+        print(' '.join(['%d MHz: %0.2f' % (f, r) for f, r in zip(scan.frequencies, scan.scaled())]))
         
         # Do the same scan but using the frequency list, use only receiver B
-        rssi = fusion.rssi_scan_list(freqs, rx_use=2)
-        print(' '.join(['%d MHz: %0.2f' % (f, r) for f, r in zip(freqs, rssi)]))
+        scan = fusion.rssi_scan_list(scan.frequencies, rx_use=2)
+        print(' '.join(['%d MHz: %0.2f' % (f, r) for f, r in zip(scan.frequencies, scan.scaled())]))
         '''
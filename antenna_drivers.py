@@ -0,0 +1,62 @@
+import importlib
+
+
+class AntennaDriver:
+    # Describes an antenna driver without importing it. The module is
+    # only imported when a station actually uses the driver, so the
+    # tower never loads serial or receiver code.
+
+    def __init__(self, name, module, className, hardwareSweep=False,
+                 dualReceiver=False, rssiUnits='dBm', activityThreshold=None):
+        self.name = name
+        self.module = module
+        self.className = className
+        # Capabilities
+        self.hardwareSweep = hardwareSweep  # Measures a frequency list by itself
+        self.dualReceiver = dualReceiver  # Diversity receivers A and B
+        self.rssiUnits = rssiUnits  # Unit of the RSSI values it reports
+        # RSSI from which a frequency counts as active for the adaptive
+        # iterator, None if there is no sensible default for the receiver
+        self.activityThreshold = activityThreshold
+
+        self.driverClass = None
+
+    def load(self):
+        # The AntennaWorker subclass, imported on first use
+        if self.driverClass is None:
+            module = importlib.import_module(self.module)
+            self.driverClass = getattr(module, self.className)
+        return self.driverClass
+
+    def create(self, config):
+        return self.load().fromConfig(config)
+
+
+drivers = {}
+# Driver of each band for station configs without "antennaDriver"
+bandDrivers = {}
+
+
+def registerDriver(driver, bands=()):
+    drivers[driver.name] = driver
+    for band in bands:
+        bandDrivers[band] = driver.name
+
+
+def findDriver(config):
+    # The driver named by "antennaDriver", or the one of the band
+    name = config.get("antennaDriver") or bandDrivers.get(config["frequencyRange"])
+    if name is None:
+        return None
+    try:
+        return drivers[name]
+    except KeyError:
+        raise ValueError(f'Unknown antenna driver {name}') from None
+
+
+registerDriver(AntennaDriver('antenna_1_2', 'antenna_1_2', 'Antenna_1_2'),
+               bands=['1.2'])
+registerDriver(AntennaDriver('tbs_fusion', 'antenna_5_8', 'Antenna_5_8',
+                             hardwareSweep=True, dualReceiver=True,
+                             rssiUnits='0..1', activityThreshold=0.5),
+               bands=['5.8'])
@@ -0,0 +1,156 @@
+from PySide6.QtCore import QObject, QThread, Qt, Slot, Signal
+import collections
+import time
+
+# A frequency change sent to the antenna. RSSI measured from settledAt
+# on, until the next tune is sent, belongs to this frequency.
+Tune = collections.namedtuple('Tune', ['sequence', 'frequency', 'sentAt', 'settledAt'])
+
+# RSSI of one frequency reduced from one or more reads: the mean of all
+# receivers, the highest single value, and the diversity-combined value
+# (the better receiver of each read, averaged). sequence is the one of
+# the tune it belongs to, None if unknown.
+RssiReading = collections.namedtuple(
+    'RssiReading', ['frequency', 'mean', 'max', 'diversity', 'reads', 'timestamp', 'sequence'])
+
+
+def reduceRssi(frequency, reads, timestamp, sequence=None, numReads=None):
+    # reads are (rssi_a, rssi_b) tuples, one per receiver read. A driver
+    # that only gets the mean of each receiver over several reads passes
+    # that as the one read and numReads for the number behind it, max
+    # and diversity are then those of the means.
+    values = [value for read in reads for value in read]
+    return RssiReading(
+        frequency,
+        sum(values) / len(values),
+        max(values),
+        sum(max(read) for read in reads) / len(reads),
+        len(reads) if numReads is None else numReads,
+        timestamp,
+        sequence)
+
+
+def settleTimeFromConfig(config):
+    # Optional "antennaSettleMs" config, None for the antenna default
+    settleMs = config.get("antennaSettleMs")
+    return None if settleMs is None else settleMs / 1000
+
+
+class AntennaWorker(QObject):
+    # Frequency, RSSI and the monotonic time it was received at
+    onRssiReceived = Signal(str, str, float)
+    # The same reading as an RssiReading, for drivers that have one
+    onRssiReading = Signal(object)
+    onRssiReadError = Signal()
+    # A command was not accepted by the receiver
+    onCommandError = Signal(str)
+    # Result of a hardware sweep: list of (frequency, rssi) and the
+    # monotonic time it was received at
+    onSweepReceived = Signal(object, float)
+    # The port is open, or could not be opened
+    onReady = Signal()
+    onError = Signal(str)
+
+    closeRequested = Signal()
+
+    # Seconds after a tune before the RSSI is trusted
+    defaultSettleTime = 0.05
+    # Number of recent tunes kept for matching late readings
+    maxTunes = 16
+
+    def __init__(self, comPort, settleTime=None):
+        super().__init__()
+
+        self.comPort = comPort
+        self.ioThread = None
+
+        self.settleTime = self.defaultSettleTime if settleTime is None else settleTime
+        self.tuneSequence = 0
+        self.tunes = collections.deque(maxlen=self.maxTunes)
+        # Readings taken while the antenna was switching frequency
+        self.unsettledReadings = 0
+
+    @classmethod
+    def fromConfig(cls, config):
+        # Create the antenna for a station config, see antenna_drivers
+        return cls(config["comPort"], settleTimeFromConfig(config))
+
+    def start(self):
+        # The antenna lives on its own I/O thread from here on: serial
+        # reads and blocking calls never wait for the UI event loop and
+        # the UI never waits for the port. Only talk to it through
+        # signals (queued connections) after this.
+        self.ioThread = QThread()
+        self.ioThread.setObjectName(f'Antenna {self.comPort}')
+        self.moveToThread(self.ioThread)
+
+        self.ioThread.started.connect(self.onThreadStarted)
+        self.closeRequested.connect(self.onCloseRequested,
+                                    Qt.BlockingQueuedConnection)
+        self.ioThread.start()
+
+    def stop(self):
+        # Close the port on the I/O thread, then end the thread
+        if self.ioThread is None:
+            return
+        self.closeRequested.emit()
+        self.ioThread.quit()
+        self.ioThread.wait()
+        self.ioThread = None
+
+    @Slot()
+    def onThreadStarted(self):
+        try:
+            self.setupComPort()
+        except Exception as e:
+            self.onError.emit(f'Failed to connect to comport {self.comPort}: {e}')
+            return
+        self.onReady.emit()
+
+    @Slot()
+    def onCloseRequested(self):
+        self.closePort()
+
+    @Slot(object)
+    def sweepFrequencies(self, frequencies):
+        # Measure the RSSI of all frequencies in one request, only for
+        # drivers registered with hardwareSweep. A failed sweep emits
+        # onSweepReceived with no pairs.
+        self.onCommandError.emit('Hardware sweep is not supported')
+        self.onSweepReceived.emit([], time.monotonic())
+
+    def sweepDuration(self, frequencies):
+        # Expected time of a hardware sweep in seconds, None if unknown.
+        # Only reads the settings, may be called from any thread.
+        return None
+
+    def setupComPort(self):
+        # Open the port, runs on the I/O thread. Every driver implements
+        # it, the error is reported through onError.
+        raise NotImplementedError(f'{type(self).__name__} does not implement setupComPort')
+
+    def closePort(self):
+        # Close the port, runs on the I/O thread
+        pass
+
+    def summary(self):
+        # Counters for the station status, read from the UI thread
+        return f'{self.unsettledReadings} unsettled readings'
+
+    def beginTune(self, frequency, sentAt):
+        # Record a tune command, sentAt is when the antenna got it
+        self.tuneSequence += 1
+        tune = Tune(self.tuneSequence, frequency, sentAt, sentAt + self.settleTime)
+        self.tunes.append(tune)
+        return tune
+
+    def tuneAt(self, timestamp):
+        # The tune a reading taken at timestamp belongs to, None while
+        # the antenna was switching or before the first tune. May be
+        # called from other threads, so it works on a snapshot.
+        for tune in reversed(tuple(self.tunes)):
+            if tune.sentAt <= timestamp:
+                if timestamp < tune.settledAt:
+                    return None
+                return tune
+        return None
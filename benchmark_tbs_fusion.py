@@ -0,0 +1,302 @@
+"""Micro-benchmarks of the TBS Fusion protocol stack
+
+Measures the CRC, frame encoding and decoding in memory, and the
+set_frequency() and rssi_scan_list() round trips against the simulated
+receiver of tbs_fusion_sim. The results are written as JSON so runs on
+different commits can be compared.
+
+Before benchmarking, the CRC and the frame encoding are checked against
+known values, and against pycrc's bit by bit CRC if pycrc is installed
+(pip install pycrc). Use --check to only run the checks.
+
+Usage: python benchmark_tbs_fusion.py [options]
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from tbs_fusion import (FrameEncoder, FrameParser, MsgType, TBSFusion,
+                        MAX_LIST_SCAN_FREQS, crc16_ccitt,
+                        ACK_PAYLOAD, FREQ_RSSI_PAYLOAD, SET_FREQ_PAYLOAD,
+                        RANGE_SCAN_PAYLOAD)
+from tbs_fusion_sim import FusionSimulator
+
+# Percentiles reported for round trip latencies
+PERCENTILES = (50, 99, 99.9)
+
+# List lengths used for the rssi_scan_list() benchmark
+SCAN_LIST_LENGTHS = (2, 4, 8, 16, 32, 64, MAX_LIST_SCAN_FREQS)
+
+# CRC-16/CCITT-FALSE check value, the CRC of b'123456789'
+CRC_CHECK_VALUE = 0x29B1
+
+# set_frequency(5800) for address 1, as sent to the receiver
+SET_FREQUENCY_5800_FRAME = bytes.fromhex('aa55c1a8010302a816')
+
+
+def _example_frames(encoder, address=1):
+    """One representative frame per message type, by MsgType
+
+    Each value is a function that encodes the frame with the given
+    encoder, as done by TBSFusion and the simulator.
+    """
+    frequencies = list(range(5000, 5000 + 2 * MAX_LIST_SCAN_FREQS, 2))
+    scan_response = bytes(range(255))
+    return {
+        MsgType.ACK: lambda: encoder.encode_struct(
+            address, MsgType.ACK, ACK_PAYLOAD,
+            MsgType.COMMAND_SET_FREQUENCY.value, 0),
+        MsgType.FREQUENCY_RSSI_REQUEST: lambda: encoder.encode(
+            address, MsgType.FREQUENCY_RSSI_REQUEST),
+        MsgType.FREQUENCY_RSSI_RESPONSE: lambda: encoder.encode_struct(
+            address, MsgType.FREQUENCY_RSSI_RESPONSE, FREQ_RSSI_PAYLOAD,
+            5800, 120, 110),
+        MsgType.COMMAND_SET_FREQUENCY: lambda: encoder.encode_struct(
+            address, MsgType.COMMAND_SET_FREQUENCY, SET_FREQ_PAYLOAD, 5800),
+        MsgType.FREQUENCY_RANGE_SCAN_REQUEST: lambda: encoder.encode_struct(
+            address, MsgType.FREQUENCY_RANGE_SCAN_REQUEST, RANGE_SCAN_PAYLOAD,
+            5000, 5255, 1, 0, 25),
+        MsgType.FREQUENCY_LIST_SCAN_REQUEST: lambda: encoder.encode_list_scan(
+            address, frequencies, 0, 40),
+        MsgType.FREQUENCY_SCAN_RESPONSE: lambda: encoder.encode(
+            address, MsgType.FREQUENCY_SCAN_RESPONSE, scan_response),
+    }
+
+
+def _percentile(sorted_values, percentile):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = int(round(percentile / 100 * len(sorted_values) + 0.5)) - 1
+    return sorted_values[min(max(rank, 0), len(sorted_values) - 1)]
+
+
+def _timed(function, min_time):
+    """Call function repeatedly for at least min_time seconds
+
+    Returns
+    -------
+    rate : float
+        Number of calls per second.
+    """
+    count = 0
+    batch = 1
+    t_start = time.perf_counter()
+    while True:
+        for _ in range(batch):
+            function()
+        count += batch
+        elapsed = time.perf_counter() - t_start
+        if elapsed >= min_time:
+            return count / elapsed
+        batch *= 2
+
+
+def check_encoding(samples=200):
+    """Check the CRC and the frame encoding against known values
+
+    If pycrc is installed, crc16_ccitt() is also compared with its bit
+    by bit implementation for random data of up to a full frame.
+
+    Returns
+    -------
+    errors : list of str
+        One message per failed check, empty if all passed.
+    """
+    errors = []
+    crc = crc16_ccitt(b'123456789')
+    if crc != CRC_CHECK_VALUE:
+        errors.append('CRC of b\'123456789\' is 0x%04X, expected 0x%04X'
+                      % (crc, CRC_CHECK_VALUE))
+
+    frame = bytes(FrameEncoder().encode_struct(
+        1, MsgType.COMMAND_SET_FREQUENCY, SET_FREQ_PAYLOAD, 5800))
+    if frame != SET_FREQUENCY_5800_FRAME:
+        errors.append('set_frequency(5800) frame is %s, expected %s'
+                      % (frame.hex(), SET_FREQUENCY_5800_FRAME.hex()))
+
+    try:
+        from pycrc.algorithms import Crc
+    except ImportError:
+        return errors
+    reference = Crc(width=16, poly=0x1021, reflect_in=False, xor_in=0xFFFF,
+                    reflect_out=False, xor_out=0x0000)
+    generator = random.Random(0)
+    for _ in range(samples):
+        data = bytes(generator.getrandbits(8)
+                     for _ in range(generator.randrange(265)))
+        crc = crc16_ccitt(data)
+        expected = reference.bit_by_bit_fast(data)
+        if crc != expected:
+            errors.append('CRC of %s is 0x%04X, pycrc gives 0x%04X'
+                          % (data.hex(), crc, expected))
+            break
+    return errors
+
+
+def benchmark_crc(min_time, size=4096):
+    """CRC throughput in bytes per second"""
+    data = os.urandom(size)
+    rate = _timed(lambda: crc16_ccitt(data), min_time)
+    return {'block_size': size, 'bytes_per_s': rate * size}
+
+
+def benchmark_encode(min_time):
+    """Frames encoded per second, by message type name"""
+    encoder = FrameEncoder()
+    results = {}
+    for msg_type, encode in _example_frames(encoder).items():
+        length = len(encode())
+        results[msg_type.name] = {'frame_size': length,
+                                  'frames_per_s': _timed(encode, min_time)}
+    return results
+
+
+def benchmark_decode(min_time, frames_per_chunk=100):
+    """Frames decoded per second, by message type name
+
+    The parser is fed chunks of back to back frames, like a busy port,
+    and every frame is taken out of it.
+    """
+    encoder = FrameEncoder()
+    parser = FrameParser()
+    results = {}
+    for msg_type, encode in _example_frames(encoder).items():
+        chunk = bytes(encode()) * frames_per_chunk
+
+        def decode():
+            parser.feed(chunk)
+            for _ in parser.frames():
+                pass
+
+        rate = _timed(decode, min_time)
+        results[msg_type.name] = {'frame_size': len(chunk) // frames_per_chunk,
+                                  'frames_per_s': rate * frames_per_chunk}
+    return results
+
+
+def benchmark_set_frequency(port, baudrate, iterations):
+    """Round trip latency of set_frequency() in seconds"""
+    fusion = TBSFusion(port, baudrate=baudrate, timeout=0.5)
+    try:
+        latencies = []
+        for i in range(iterations):
+            frequency = 5000 + i % 1000
+            t_start = time.perf_counter()
+            fusion.set_frequency(frequency)
+            latencies.append(time.perf_counter() - t_start)
+    finally:
+        fusion.close()
+
+    latencies.sort()
+    results = {'iterations': iterations,
+               'mean_s': sum(latencies) / len(latencies),
+               'min_s': latencies[0],
+               'max_s': latencies[-1],
+               'retries': fusion.command_retries}
+    for percentile in PERCENTILES:
+        results['p%s_s' % ('%g' % percentile).replace('.', '')] = \
+            _percentile(latencies, percentile)
+    return results
+
+
+def benchmark_scan_list(port, baudrate, repeats, delay_ms,
+                        lengths=SCAN_LIST_LENGTHS):
+    """Points per second of rssi_scan_list(), by list length"""
+    fusion = TBSFusion(port, baudrate=baudrate, timeout=0.5)
+    results = []
+    try:
+        for length in lengths:
+            frequencies = list(range(5000, 5000 + length))
+            t_start = time.perf_counter()
+            for _ in range(repeats):
+                fusion.rssi_scan_list(frequencies, delay_ms=delay_ms)
+            elapsed = time.perf_counter() - t_start
+            results.append({'length': length,
+                            'scans': repeats,
+                            'seconds_per_scan': elapsed / repeats,
+                            'points_per_s': length * repeats / elapsed})
+    finally:
+        fusion.close()
+    return results
+
+
+def _git_commit():
+    """Commit the benchmark is run on, or None outside a git checkout"""
+    try:
+        output = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.strip()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the TBS Fusion protocol stack')
+    parser.add_argument('-o', '--output',
+                        help='write the JSON results to this file '
+                             '(default: stdout)')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='seconds per in-memory benchmark')
+    parser.add_argument('--iterations', type=int, default=2000,
+                        help='set_frequency() round trips')
+    parser.add_argument('--scan-repeats', type=int, default=5,
+                        help='rssi_scan_list() calls per list length')
+    parser.add_argument('--scan-delay-ms', type=int, default=0,
+                        help='delay_ms of the scans, 0 measures the '
+                             'protocol overhead only')
+    parser.add_argument('--baudrate', type=int, default=115200,
+                        help='baudrate the simulator paces responses to')
+    parser.add_argument('--skip-serial', action='store_true',
+                        help='only run the in-memory benchmarks')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the CRC and the frame encoding')
+    args = parser.parse_args(argv[1:])
+
+    # Fast code that gives wrong frames is not worth measuring
+    errors = check_encoding()
+    for error in errors:
+        print(error, file=sys.stderr)
+    if errors or args.check:
+        return 1 if errors else 0
+
+    results = {
+        'commit': _git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'crc': benchmark_crc(args.min_time),
+        'encode': benchmark_encode(args.min_time),
+        'decode': benchmark_decode(args.min_time),
+    }
+
+    if not args.skip_serial:
+        with FusionSimulator(baudrate=args.baudrate) as simulator:
+            results['set_frequency'] = benchmark_set_frequency(
+                simulator.port, args.baudrate, args.iterations)
+            results['rssi_scan_list'] = benchmark_scan_list(
+                simulator.port, args.baudrate, args.scan_repeats,
+                args.scan_delay_ms)
+        results['simulator'] = {'baudrate': args.baudrate,
+                                'latency_s': {t.name: v for t, v in
+                                              simulator.latency.items()}}
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -1,96 +1,355 @@
 # This Python file uses the following encoding: utf-8
 
-import asyncio
-import queue
+import bisect
+import heapq
+import itertools
+import logging
 import threading
+import time
 from PySide6.QtCore import QObject, Signal
 
+LOGGER = logging.getLogger(__name__)
+
+
+class DwellTimer:
+    # Handle of a scheduled callback, see DwellScheduler.schedule()
+
+    def __init__(self, deadline, callback):
+        self.deadline = deadline
+        self.callback = callback
+        self.isCancelled = False
+
+    def cancel(self):
+        self.isCancelled = True
+
+
+class DwellScheduler:
+    # Runs the dwell timers of all iterators on one daemon thread. The
+    # timers are kept in a heap ordered by deadline, so scheduling is
+    # O(log n) and the thread only wakes up for the earliest one.
+    # Callbacks run on the scheduler thread and must not block. An
+    # exception in one is logged and the thread goes on with the others.
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        return self.scheduleAt(time.monotonic() + delay, callback)
+
+    def scheduleAt(self, deadline, callback):
+        # Run callback at deadline on the time.monotonic() clock
+        timer = DwellTimer(deadline, callback)
+        with self.cond:
+            # The counter keeps timers with the same deadline in order
+            heapq.heappush(self.heap, (timer.deadline, next(self.counter), timer))
+            # Also restarts the thread if it ever died
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True,
+                                               name='DwellScheduler')
+                self.thread.start()
+            # Wake up the thread if this is the new earliest deadline
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+        return timer
+
+    def run(self):
+        try:
+            self.runTimers()
+        finally:
+            # Only reached if the thread dies, the next schedule()
+            # starts a new one
+            with self.cond:
+                if self.thread is threading.current_thread():
+                    self.thread = None
+
+    def runTimers(self):
+        while True:
+            with self.cond:
+                while True:
+                    # Cancelled timers are dropped once they come up
+                    while self.heap and self.heap[0][2].isCancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    remaining = self.heap[0][0] - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                _, _, timer = heapq.heappop(self.heap)
+
+            try:
+                timer.callback()
+            except Exception:
+                LOGGER.exception('Dwell timer callback failed')
+
+
+scheduler = DwellScheduler()
+
+
+class JitterStats:
+    # How late the steps of an iterator fired compared to their
+    # deadline, in seconds
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, lateness):
+        self.count += 1
+        self.total += lateness
+        self.max = max(self.max, lateness)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return f'{self.count} steps, jitter mean {1000 * self.mean:.1f} ms, max {1000 * self.max:.1f} ms'
+
+
+class AdaptiveSchedule:
+    # Weighted fair order of visits (stride scheduling): every frequency
+    # has a pass value, the lowest one is visited next and its pass
+    # grows by 1 / weight. Frequencies with recent RSSI above the
+    # threshold have a higher weight, so they are revisited more often
+    # and get a longer dwell. Long quiet ones have a lower weight, but
+    # their pass value still comes up, so they are never starved.
+
+    activeWeight = 4
+    quietWeight = 0.5
+    activeDwellFactor = 2
+    activityWindow = 30 # seconds a reading above the threshold counts as active
+    quietTime = 120 # seconds without activity until a frequency is long quiet
+
+    def __init__(self, frequencies, threshold, lastActive):
+        self.threshold = threshold
+        # Time of the last reading above the threshold, by frequency.
+        # Owned by the iterator so it survives restarts.
+        self.lastActive = lastActive
+        self.startTime = time.monotonic()
+
+        self.passes = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.virtualTime = 0.0
+        for frequency in frequencies:
+            self.setPass(frequency, 0.0)
+
+    def setPass(self, frequency, value):
+        # Older heap entries of the frequency become stale and are
+        # skipped in next()
+        self.passes[frequency] = value
+        heapq.heappush(self.heap, (value, next(self.counter), frequency))
+
+    def weight(self, frequency, now):
+        lastActive = self.lastActive.get(frequency)
+        if lastActive is not None and now - lastActive < self.activityWindow:
+            return self.activeWeight
+        quietSince = self.startTime if lastActive is None else max(lastActive, self.startTime)
+        if now - quietSince > self.quietTime:
+            return self.quietWeight
+        return 1.0
+
+    def next(self):
+        # The frequency to visit and how many dwells to stay on it
+        now = time.monotonic()
+        while True:
+            value, _, frequency = heapq.heappop(self.heap)
+            if self.passes.get(frequency) == value:
+                break
+        self.virtualTime = value
+
+        weight = self.weight(frequency, now)
+        self.setPass(frequency, value + 1 / weight)
+        return frequency, self.activeDwellFactor if weight == self.activeWeight else 1
+
+    def report(self, frequency, rssi):
+        if frequency not in self.passes:
+            return
+        try:
+            if float(rssi) < self.threshold:
+                return
+        except ValueError:
+            return
+
+        self.lastActive[frequency] = time.monotonic()
+        # Bring a newly active frequency up soon instead of after its
+        # quiet stride
+        soon = self.virtualTime + 1 / self.activeWeight
+        if self.passes[frequency] > soon:
+            self.setPass(frequency, soon)
+
+
+def partitionFrequencies(frequencies, index, count, interleaved):
+    # Slice index of count of an ascending sequence of frequencies,
+    # every count-th one or a contiguous block. Slicing keeps a range a
+    # range. With more slices than frequencies, slices are shared.
+    count = min(count, len(frequencies))
+    if count == 0:
+        return frequencies
+    index %= count
+    if interleaved:
+        return frequencies[index::count]
+    length = len(frequencies)
+    return frequencies[length * index // count:length * (index + 1) // count]
+
+
 class FrequencyIterator(QObject):
-    emitFrequency = Signal(str)
+    emitFrequency = Signal(int)
+    emitSweep = Signal(object)
 
     def __init__(self):
         super().__init__()
 
-        self.queue = None
+        # Ascending integer frequencies, usually a range, and the index
+        # of the next one to emit
+        self.frequencies = None
+        self.cursor = 0
         self.isStopped = True
-        self.currentTask = None
-        self.loop = None
+        self.timer = None
+        # Incremented by start and stop, timers of an older run do nothing
+        self.generation = 0
+        self.lock = threading.Lock()
+        # Deadline of the next step, each one is the previous plus the
+        # delay so timing errors don't add up over a sweep
+        self.deadline = None
+        self.jitter = JitterStats()
+        # Adaptive mode, see AdaptiveSchedule
+        self.adaptive = None
+        self.lastActive = {}
 
 
-    def start(self, list, current, delay, implicitTrigger):
-        self.queue = queue.Queue()
-        self.list = list
-        self.delay = delay
-        self.implicitTrigger = implicitTrigger
+    def start(self, frequencies, current, delayMs, implicitTrigger, adaptiveThreshold=None):
+        # frequencies is an ascending sequence of int, a range costs
+        # nothing to set up however fine the step is. Nothing is
+        # scheduled for an empty one.
+        if not frequencies:
+            self.stop()
+            return
 
-        isExactIndex = True
+        if adaptiveThreshold is not None:
+            self.startAdaptive(frequencies, delayMs, implicitTrigger, adaptiveThreshold)
+            return
 
-        try:
-            currentIndex = list.index(current)
-        except ValueError:
-            isExactIndex = False
+        # Resume after the current frequency, or at the first one above
+        # it if it isn't in the sequence
+        cursor = bisect.bisect_right(frequencies, int(current)) % len(frequencies)
 
-            currentIndex = self.findFrequencyIndexInList(list, current)
+        with self.lock:
+            self.cancelTimer()
+            self.adaptive = None
+            self.frequencies = frequencies
+            self.cursor = cursor
+            self.delay = delayMs / 1000
+            self.isStopped = False
+            self.jitter.reset()
+            self.deadline = time.monotonic()
+            self.scheduleNext(self.processQueue, 0 if implicitTrigger else None)
 
-        nextIndex = currentIndex if not isExactIndex else currentIndex + 1
+    def startAdaptive(self, frequencies, delayMs, implicitTrigger, threshold):
+        # Visit order and dwell follow the RSSI reported with reportRssi()
+        if not frequencies:
+            self.stop()
+            return
 
-        if self.implicitTrigger:
-            self.emitFrequency.emit(list[nextIndex])
-            nextIndex += 1
+        with self.lock:
+            self.cancelTimer()
+            self.adaptive = AdaptiveSchedule(frequencies, threshold, self.lastActive)
+            self.delay = delayMs / 1000
+            self.isStopped = False
+            self.jitter.reset()
+            self.deadline = time.monotonic()
+            self.scheduleNext(self.processAdaptive, 0 if implicitTrigger else None)
 
-        for item in list[nextIndex:]:
-            self.queue.put(item)
+    def reportRssi(self, frequency, rssi):
+        with self.lock:
+            if self.adaptive is not None:
+                self.adaptive.report(frequency, rssi)
 
-        if self.isStopped:
+    def startSweep(self, frequencies, delayMs):
+        # Hardware sweep: the antenna measures the whole list in one
+        # request, repeated every delayMs milliseconds
+        if not frequencies:
+            self.stop()
+            return
+
+        with self.lock:
+            self.cancelTimer()
+            self.adaptive = None
+            self.frequencies = frequencies
+            self.delay = delayMs / 1000
             self.isStopped = False
-            threading.Thread(target=self.processQueue).start()
+            self.jitter.reset()
+            self.deadline = time.monotonic()
+            self.scheduleNext(self.processSweep, 0)
 
     def stop(self):
-        self.isStopped = True
-        if self.currentTask:
-            self.currentTask.cancel()
+        with self.lock:
+            self.isStopped = True
+            self.cancelTimer()
 
-        if self.loop and self.loop.is_running():
-            self.loop.stop()
 
+    def cancelTimer(self):
+        self.generation += 1
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
 
-    async def process_item(self, frequency):
-        self.currentTask = asyncio.create_task(self.createTask(frequency, self.delay))
-        try:
-            await self.currentTask
+    def scheduleNext(self, step, delay=None):
+        generation = self.generation
+        self.deadline += self.delay if delay is None else delay
 
-        except asyncio.exceptions.CancelledError:
-            pass  # Ignore cancelled tasks on shutdown
+        # After falling behind by more than a step (e.g. the machine was
+        # suspended), continue from now instead of catching up in a burst
+        now = time.monotonic()
+        if self.deadline < now - self.delay:
+            self.deadline = now
 
+        self.timer = scheduler.scheduleAt(self.deadline, lambda: step(generation))
 
-    async def createTask(self, frequency, delay):
-        await asyncio.sleep(self.delay)
-        self.emitFrequency.emit(frequency)
+    def recordJitter(self):
+        self.jitter.record(max(0.0, time.monotonic() - self.deadline))
+
+    def processQueue(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.recordJitter()
+
+            frequency = self.frequencies[self.cursor]
+            self.cursor = (self.cursor + 1) % len(self.frequencies)
 
-    def processQueue(self):
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
+            self.scheduleNext(self.processQueue)
 
-        while not self.isStopped:
-            if self.queue.qsize() > 0:
-                try:
-                    self.loop.run_until_complete(self.process_item(self.queue.get()))
-                except RuntimeError:
-                    pass # ignore Event loop stopped before Future completed
+        self.emitFrequency.emit(frequency)
+
+    def processAdaptive(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.recordJitter()
 
-            else:
-                for item in self.list:
-                    self.queue.put(item)
+            frequency, dwells = self.adaptive.next()
+            self.scheduleNext(self.processAdaptive, dwells * self.delay)
 
-        self.loop.close()
+        self.emitFrequency.emit(frequency)
 
+    def processSweep(self, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.recordJitter()
+            frequencies = self.frequencies
 
-    def findFrequencyIndexInList(self, list, frequency):
-        i = 0
+            self.scheduleNext(self.processSweep)
 
-        while int(list[i]) < int(frequency):
-            i += 1
-            if i >= len(list):
-                return 0
+        self.emitSweep.emit(frequencies)
 
-        return i
@@ -1 +1 @@
-pip install PySide6 pika ppft pyserial pycrc
\ No newline at end of file
+pip install PySide6 pika pyserial pyserial-asyncio
\ No newline at end of file
@@ -2,17 +2,17 @@
 
 from PySide6.QtWidgets import (
 QWidget, QVBoxLayout, QHBoxLayout, QLabel, QSpinBox, QComboBox, QTableWidget, QTableWidgetItem, QHeaderView, QAbstractItemView,
-QGroupBox, QButtonGroup, QGridLayout, QRadioButton, QToolButton, QDialog, QListWidget
+QGroupBox, QButtonGroup, QGridLayout, QRadioButton, QToolButton, QDialog, QListWidget, QCheckBox
 )
 from PySide6.QtCore import Signal, Slot, Qt, QMetaEnum, QThread, QTimer
 from PySide6.QtGui import QPixmap, QIcon, QStandardItemModel, QStandardItem
 from rabbit_utils import RabbitMQPublisher, RabbitMQConsumer
-from iterator import FrequencyIterator
-from antenna_1_2 import Antenna_1_2
-from antenna_5_8 import Antenna_5_8
+from iterator import FrequencyIterator, partitionFrequencies
+from antenna_drivers import findDriver
 from utility import findPresetByName
 
 import logging
+import time
 
 LOG_FORMAT = ('%(levelname) -10s %(asctime)s %(name) -30s %(funcName) '
               '-35s %(lineno) -5d: %(message)s')
@@ -22,19 +22,36 @@ class IteratorMode(QMetaEnum):
     WithinPreset = 'Within Preset'
     ByStep = 'By Step'
 
+class PartitionMode(QMetaEnum):
+    # How the tower splits a band among its active stations
+    FullBand = 'Full band'
+    Interleaved = 'Interleaved'
+    Contiguous = 'Contiguous'
+
 class StationWidget(QWidget):
     maxHistoryLength = 5
-    iteratorDelayMinimum = 1
-    iteratorDelayMaximum = 10
-    defaultIteratorDelay = 3
+    # Iterator dwell in milliseconds
+    iteratorDelayMinimum = 20
+    iteratorDelayMaximum = 10000
+    iteratorDelayStep = 50
+    defaultIteratorDelay = 3000
     defaultIteratorMode = IteratorMode.WithinPreset
     antenna = None
     antennaIsReady = False
+    lastRssiReading = None
+    sweepTimeout = 10 # seconds past the expected sweep time until it is given up
 
     stopStation = Signal()
     syncWithCurrentStation = Signal(str, str)
     localModeActivated = Signal(bool)
     onFrequencySet = Signal(str)
+    onSweepRequested = Signal(object)
+    onSweepMessage = Signal(str)
+    onModeMessage = Signal(str)
+    # The user started or stopped the iterator
+    iteratorToggled = Signal(bool)
+    # The remote station went local or back to the cloud (tower)
+    remoteModeChanged = Signal(bool)
     antennaRssiReceived = Signal(str)
     rabbitMQPublisherStart = Signal()
     rabbitMQConsumerStart = Signal()
@@ -50,6 +67,8 @@ class StationWidget(QWidget):
         self.currentPreset = findPresetByName(config["frequencyRange"], config, presets)
 
         self.stationName = self.config["stationName"]
+        # Only looked up here, the driver is imported when it's used
+        self.antennaDriver = findDriver(config)
 
         self.isLocalModeActive = not isStationMode
         self.frequency = self.currentPreset["minFrequency"]
@@ -58,9 +77,25 @@ class StationWidget(QWidget):
         self.isFrequencyIteratorActive = False
         self.iteratorMode = self.defaultIteratorMode
         self.iterator = None
-        self.iteratorDelay = self.defaultIteratorDelay
+        self.iteratorDelay = self.config.get("iteratorDelayMs", self.defaultIteratorDelay)
+        self.isSweepEnabled = False
+        self.sweepRequestedAt = None
+        self.sweepsInFlight = 0
+        self.sweepDeadline = None
+        # Measured time of the last sweep, the tower has no antenna to
+        # estimate it
+        self.lastSweepDuration = 0.0
+        self.isAdaptiveEnabled = False
+        # Slice of the band set by the tower: (index, count, PartitionMode),
+        # None for the full band
+        self.partition = None
+        self.isRemoteLocalModeActive = False
+        # RSSI from which a frequency counts as active, see AdaptiveSchedule
+        self.adaptiveThreshold = self.config.get(
+            "adaptiveThreshold", self.antennaDriver.activityThreshold if self.antennaDriver else None)
 
         self.frequencyStepOptions = ['1', '5', '10', '20']
+        self.presetFrequencies = sorted(int(frequency) for frequency in self.currentPreset['presetFrequencies'])
 
         self.frequencySpinnerMinimum = int(self.currentPreset["minFrequency"])
         self.frequencySpinnerMaximum = int(self.currentPreset["maxFrequency"])
@@ -79,9 +114,9 @@ class StationWidget(QWidget):
         self.syncUI()
 
         if self.isStationMode:
-            self.setupAntenna(self.config["frequencyRange"], self.config["comPort"])
-
-        if self.antennaIsReady:
+            # RabbitMQ is set up once the antenna is ready
+            self.setupAntenna()
+        else:
             self.setupRabbitMQ()
 
 
@@ -119,11 +154,20 @@ class StationWidget(QWidget):
         self.frequencySpinnerStepList.addItems(self.frequencyStepOptions)
 
         self.historyTable = QTableWidget(0, 2)
-        self.historyTable.setHorizontalHeaderLabels(['Frequency (MHz)', 'RSSI (dBm)'])
+        rssiUnits = self.antennaDriver.rssiUnits if self.antennaDriver else 'dBm'
+        self.historyTable.setHorizontalHeaderLabels(['Frequency (MHz)', f'RSSI ({rssiUnits})'])
         self.historyTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
         self.historyTable.verticalHeader().hide()
         self.historyTable.setEditTriggers(QAbstractItemView.NoEditTriggers)
 
+        # All frequencies of the last hardware sweep
+        self.sweepTable = QTableWidget(0, 2, toolTip='Last hardware sweep')
+        self.sweepTable.setHorizontalHeaderLabels(['Frequency (MHz)', f'RSSI ({rssiUnits})'])
+        self.sweepTable.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.sweepTable.verticalHeader().hide()
+        self.sweepTable.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.sweepTable.setVisible(self.canSweep())
+
         self.iteratorFrequencyWithinPresetModeRadio = QRadioButton(IteratorMode.WithinPreset)
         self.iteratorFrequencyByStepModeRadio = QRadioButton(IteratorMode.ByStep)
 
@@ -141,6 +185,21 @@ class StationWidget(QWidget):
         self.iteratorFrequencyStepList = QComboBox( toolTip='Frequency spinner step')
         self.iteratorFrequencyStepList.addItems(self.frequencyStepOptions)
 
+        self.iteratorSweepCheckBox = QCheckBox(
+            'Hardware sweep',
+            toolTip='Measure all frequencies in one request to the receiver'
+        )
+        self.iteratorSweepCheckBox.setVisible(self.canSweep())
+
+        self.iteratorAdaptiveCheckBox = QCheckBox(
+            'Adaptive',
+            toolTip='Dwell longer on and revisit frequencies with activity more often'
+        )
+        self.iteratorAdaptiveCheckBox.setVisible(self.canAdapt())
+
+        self.partitionLabel = QLabel(objectName='partitionLabel', wordWrap=True)
+        self.partitionLabel.setVisible(False)
+
         self.iteratorToggle = QToolButton(objectName='iteratorToggle', toolTip='Frequency iterator toggle')
         self.playIcon = QIcon(QPixmap(':/img/play.png'))
         self.stopIcon = QIcon(QPixmap(':/img/stop.png'))
@@ -152,6 +211,8 @@ class StationWidget(QWidget):
             self,
             minimum=self.iteratorDelayMinimum,
             maximum=self.iteratorDelayMaximum,
+            singleStep=self.iteratorDelayStep,
+            suffix=' ms',
             objectName='iteratorDelaySpinner',
             toolTip='Frequency iterator delay'
         )
@@ -172,6 +233,7 @@ class StationWidget(QWidget):
 
         mainColumnWrapper.addLayout(frequencySpinnerRow)
         mainColumnWrapper.addWidget(self.historyTable)
+        mainColumnWrapper.addWidget(self.sweepTable)
 
         iteratorRadioGroupBox = QGroupBox('Iterator', self)
         iteratorRadioGroupBox.setAlignment(Qt.AlignHCenter)
@@ -184,6 +246,9 @@ class StationWidget(QWidget):
         iteratorRadioGroupGrid.addWidget(self.iteratorFrequencyPresetHelp, 0, 1)
         iteratorRadioGroupGrid.addWidget(self.iteratorFrequencyByStepModeRadio, 1, 0)
         iteratorRadioGroupGrid.addWidget(self.iteratorFrequencyStepList, 1, 1)
+        iteratorRadioGroupGrid.addWidget(self.iteratorSweepCheckBox, 2, 0, 1, 2)
+        iteratorRadioGroupGrid.addWidget(self.iteratorAdaptiveCheckBox, 3, 0, 1, 2)
+        iteratorRadioGroupGrid.addWidget(self.partitionLabel, 4, 0, 1, 2)
 
         iteratorToggleRow = QHBoxLayout()
         iteratorToggleRow.addWidget(self.iteratorToggle)
@@ -205,6 +270,7 @@ class StationWidget(QWidget):
         self.frequencySpinner.valueChanged.connect(self.setFrequency)
 
         self.historyTable.itemDoubleClicked.connect(self.onFrequencyHistoryItemDoubleClicked)
+        self.sweepTable.itemDoubleClicked.connect(self.onFrequencyHistoryItemDoubleClicked)
 
         self.iteratorFrequencyPresetHelp.clicked.connect(self.showPresetFrequenciesDialog)
 
@@ -213,6 +279,9 @@ class StationWidget(QWidget):
 
         self.iteratorFrequencyRadioGroup.buttonClicked.connect(self.setIteratorMode)
 
+        self.iteratorSweepCheckBox.clicked.connect(self.setIteratorSweep)
+        self.iteratorAdaptiveCheckBox.clicked.connect(self.setIteratorAdaptive)
+
         self.iteratorToggle.clicked.connect(self.onFrequencyIteratorToggled)
 
         self.iteratorDelaySpinner.valueChanged.connect(self.setIteratorDelay)
@@ -237,10 +306,15 @@ class StationWidget(QWidget):
         elif self.iteratorMode == IteratorMode.ByStep:
             self.iteratorFrequencyByStepModeRadio.setChecked(True)
 
+        self.iteratorSweepCheckBox.setChecked(self.isSweepEnabled)
+        self.iteratorAdaptiveCheckBox.setChecked(self.isAdaptiveEnabled)
+
         self.iteratorToggle.setIcon(self.stopIcon if self.isFrequencyIteratorActive else self.playIcon)
 
         self.iteratorDelaySpinner.setValue(self.iteratorDelay)
 
+        self.syncPartitionLabel()
+
         disabled = not self.isLocalModeActive
 
         self.setUIDisabled(disabled)
@@ -251,12 +325,15 @@ class StationWidget(QWidget):
         self.frequencySpinner.setDisabled(disabled)
         self.frequencySpinnerStepList.setDisabled(disabled)
         self.historyTable.setDisabled(disabled)
+        self.sweepTable.setDisabled(disabled)
 
         self.iteratorFrequencyWithinPresetModeRadio.setDisabled(disabled)
         self.iteratorFrequencyByStepModeRadio.setDisabled(disabled)
         self.iteratorFrequencyPresetHelp.setDisabled(disabled)
 
         self.iteratorFrequencyStepList.setDisabled(disabled)
+        self.iteratorSweepCheckBox.setDisabled(disabled)
+        self.iteratorAdaptiveCheckBox.setDisabled(disabled)
         self.iteratorToggle.setDisabled(disabled)
         self.iteratorDelaySpinner.setDisabled(disabled)
 
@@ -278,10 +355,12 @@ class StationWidget(QWidget):
         if self.isStationMode:
             # valkiria
             self.antennaRssiReceived.connect(self.rabbitMQPublisher.publish)
+            self.onModeMessage.connect(self.rabbitMQPublisher.publish)
             self.rabbitMQPublisher.published.connect(self.onRabbitRssiPublished)
         else:
             # tower
             self.onFrequencySet.connect(self.rabbitMQPublisher.publish)
+            self.onSweepMessage.connect(self.rabbitMQPublisher.publish)
             self.rabbitMQPublisher.published.connect(self.onRabbitFrequencyPublished)
             
         self.rabbitMQPublisherStart.connect(self.rabbitMQPublisher.start)
@@ -312,26 +391,49 @@ class StationWidget(QWidget):
 
 
     @Slot()
-    def setupAntenna(self, frequencyRange, comPort):
-        if frequencyRange == '1.2':
-            self.antenna = Antenna_1_2(comPort)
-            self.antenna.setupComPort()
+    def setupAntenna(self):
+        if self.antennaDriver is None:
+            return
+        self.antenna = self.antennaDriver.create(self.config)
+
+        # Queued connections, the antenna runs on its own thread
+        self.onFrequencySet.connect(self.antenna.setAntennaFrequency)
+        self.onSweepRequested.connect(self.antenna.sweepFrequencies)
+        self.antenna.onRssiReading.connect(self.onAntennaRssiReading)
+        self.antenna.onRssiReceived.connect(self.onAntennaRssiReceived)
+        self.antenna.onSweepReceived.connect(self.onAntennaSweepReceived)
+        self.antenna.onRssiReadError.connect(self.onAntennaRssiReadError)
+        self.antenna.onCommandError.connect(self.onAntennaCommandError)
+        self.antenna.onReady.connect(self.onAntennaReady)
+        self.antenna.onError.connect(self.onAntennaError)
+
+        self.antenna.start()
+
+
+    @Slot()
+    def onAntennaReady(self):
+        self.antennaIsReady = True
+        self.setStationStatus(f'[Antenna] Connected to {self.config["comPort"]}')
+        self.setupRabbitMQ()
 
-            self.onFrequencySet.connect(self.antenna.setAntennaFrequency)
-            self.antenna.onRssiReceived.connect(self.onAntennaRssiReceived)
-            self.antenna.onRssiReadError.connect(self.onAntennaRssiReadError)
 
-        elif frequencyRange == '5.8':
-            self.antenna = Antenna_5_8(comPort)
-            try:
-                self.antenna.setupComPort()
-                self.onFrequencySet.connect(self.antenna.setAntennaFrequency)
-                self.antenna.onRssiReceived.connect(self.onAntennaRssiReceived)
-                self.antennaIsReady = True
-            except:
-                self.setStationStatus(f'Failed to connect to comport {comPort}. Check comport and restart the app.')
-                self.setUIDisabled(True)
-                self.cloudSyncToggle.setDisabled(True)
+    @Slot(str)
+    def onAntennaError(self, error):
+        self.setStationStatus(f'{error}. Check comport and restart the app.')
+        self.setUIDisabled(True)
+        self.cloudSyncToggle.setDisabled(True)
+
+
+    @Slot(str)
+    def onAntennaCommandError(self, error):
+        self.setStationStatus(f'[Antenna] {error}')
+
+
+    def closeAntenna(self):
+        if self.antenna is not None:
+            self.antenna.stop()
+            self.antenna = None
+            self.antennaIsReady = False
 
 
     @Slot(str)
@@ -344,6 +446,13 @@ class StationWidget(QWidget):
         if self.isLocalModeActive:
             return
 
+        if frequency.startswith('sweep:'):
+            # "sweep:frequency,..." is a sweep request
+            self.setStationStatus('[RabbitMQ] Received sweep request')
+            frequencies = frequency.partition(':')[2]
+            self.requestSweep([int(f) for f in frequencies.split(',') if f])
+            return
+
         self.setStationStatus(f'[RabbitMQ] Received frequency: {frequency}')
         self.setFrequency(frequency)
 
@@ -354,23 +463,118 @@ class StationWidget(QWidget):
         
         
     @Slot(str)
-    def onRabbitRssiReceived(self, rssi):
-        self.setRssiForLatestFrequency(rssi)
-        self.setStationStatus(f'[RabbitMQ] Received RSSI: {rssi}')
+    def onRabbitRssiReceived(self, message):
+        # "frequency:rssi", or only the RSSI from stations that don't
+        # report the frequency yet. A sweep is "sweep:frequency:rssi,...",
+        # with no pairs if it failed
+        if message.startswith('mode:'):
+            self.setRemoteLocalMode(message == 'mode:local')
+            return
+
+        if message.startswith('sweep:'):
+            pairs = message.partition(':')[2]
+            self.showSweep([pair.rpartition(':')[::2] for pair in pairs.split(',') if pair])
+            return
+
+        frequency, separator, rssi = message.rpartition(':')
+        if separator:
+            self.setRssiForFrequency(frequency, rssi)
+            self.reportRssiToIterator(frequency, rssi)
+        else:
+            self.setRssiForLatestFrequency(rssi)
+        self.setStationStatus(f'[RabbitMQ] Received RSSI: {message}')
+
+
+    def setRemoteLocalMode(self, isLocal):
+        # The station ignores the frequencies published to it in local
+        # mode, so stop iterating for it
+        self.isRemoteLocalModeActive = isLocal
+        if isLocal and self.isFrequencyIteratorActive:
+            self.terminateIterator()
+        self.setStationStatus('[RabbitMQ] Station is set to local mode' if isLocal else '[RabbitMQ] Station is listening to cloud')
+        self.remoteModeChanged.emit(isLocal)
 
 
     def setRssiForLatestFrequency(self, rssi):
         self.historyTable.setItem(0, 1, QTableWidgetItem(rssi))
 
 
-    @Slot(str, str)
-    def onAntennaRssiReceived(self, frequency, rssi):
-        if frequency != self.frequency:
+    def setRssiForFrequency(self, frequency, rssi, details=''):
+        # The most recent history row of the frequency, readings can
+        # arrive after the next frequency has been set
+        for row in range(self.historyTable.rowCount()):
+            item = self.historyTable.item(row, 0)
+            if item is not None and item.text() == frequency:
+                rssiItem = QTableWidgetItem(rssi)
+                rssiItem.setToolTip(details)
+                self.historyTable.setItem(row, 1, rssiItem)
+                return True
+        return False
+
+
+    @Slot(object)
+    def onAntennaRssiReading(self, reading):
+        # Emitted right before onRssiReceived for the same reading
+        self.lastRssiReading = reading
+
+
+    def rssiReadingDetails(self, frequency, timestamp):
+        # Statistics of the RssiReading behind an onRssiReceived, if the
+        # driver has one
+        reading = self.lastRssiReading
+        if reading is None or reading.frequency != frequency or reading.timestamp != timestamp:
+            return ''
+        return f'mean {reading.mean:.2f}, max {reading.max:.2f}, {reading.reads} reads'
+
+
+    @Slot(str, str, float)
+    def onAntennaRssiReceived(self, frequency, rssi, timestamp):
+        # The antenna matched the reading to the frequency it was
+        # measured at, which is not necessarily self.frequency
+        details = self.rssiReadingDetails(frequency, timestamp)
+        if not self.setRssiForFrequency(frequency, rssi, details):
             return
-        self.setRssiForLatestFrequency(rssi)
-        self.setStationStatus(f'[Antenna] Received RSSI: {rssi}')
+        self.reportRssiToIterator(frequency, rssi)
+        self.setStationStatus(f'[Antenna] Received RSSI: {rssi} at {frequency}' + (f' ({details})' if details else ''))
+        if not self.isLocalModeActive:
+            self.antennaRssiReceived.emit(f'{frequency}:{rssi}')
+
+
+    @Slot(object, float)
+    def onAntennaSweepReceived(self, pairs, timestamp):
+        # No pairs if the sweep failed, the tower is told either way so
+        # it can request the next one
+        self.showSweep(pairs)
         if not self.isLocalModeActive:
-            self.antennaRssiReceived.emit(rssi)
+            self.antennaRssiReceived.emit('sweep:' + ','.join(f'{frequency}:{rssi}' for frequency, rssi in pairs))
+
+
+    def showSweep(self, pairs):
+        self.onSweepFinished()
+        if not pairs:
+            return
+
+        # The full vector goes to the sweep table, the history only gets
+        # the strongest frequency
+        self.sweepTable.setRowCount(len(pairs))
+        for row, (frequency, rssi) in enumerate(pairs):
+            self.sweepTable.setItem(row, 0, QTableWidgetItem(str(frequency)))
+            self.sweepTable.setItem(row, 1, QTableWidgetItem(rssi))
+            self.reportRssiToIterator(frequency, rssi)
+
+        frequency, rssi = max(pairs, key=lambda pair: float(pair[1]))
+        self.addToFrequencyHistory(frequency)
+        self.setRssiForLatestFrequency(rssi)
+        self.setStationStatus(f'[Sweep] {len(pairs)} frequencies, strongest {frequency}: {rssi}')
+
+
+    def reportRssiToIterator(self, frequency, rssi):
+        # Feedback for the adaptive iterator
+        if self.iterator is not None:
+            try:
+                self.iterator.reportRssi(int(frequency), rssi)
+            except ValueError:
+                pass
 
 
     @Slot()
@@ -418,6 +622,26 @@ class StationWidget(QWidget):
         self.syncUI()
 
 
+    @Slot(bool)
+    def setIteratorSweep(self, enabled):
+        self.isSweepEnabled = enabled
+
+        if self.isFrequencyIteratorActive:
+            self.restartIterator()
+
+        self.syncUI()
+
+
+    @Slot(bool)
+    def setIteratorAdaptive(self, enabled):
+        self.isAdaptiveEnabled = enabled
+
+        if self.isFrequencyIteratorActive:
+            self.restartIterator()
+
+        self.syncUI()
+
+
     @Slot(int)
     def setIteratorDelay(self, delay):
         self.iteratorDelay = delay
@@ -463,6 +687,8 @@ class StationWidget(QWidget):
         else:
             self.terminateIterator()
 
+        self.iteratorToggled.emit(self.isFrequencyIteratorActive)
+
 
     @Slot()
     def showPresetFrequenciesDialog(self):
@@ -485,41 +711,143 @@ class StationWidget(QWidget):
         self.setStationStatus('Station is set to local mode' if self.isLocalModeActive else 'Station is listening to cloud')
 
         self.localModeActivated.emit(self.isLocalModeActive)
+        # Tell the tower, see setRemoteLocalMode
+        self.onModeMessage.emit('mode:local' if self.isLocalModeActive else 'mode:cloud')
 
         self.syncUI()
 
 
     def startIterator(self, implicitTrigger):
+        if not self.iteratorFrequencies():
+            self.terminateIterator()
+            self.setStationStatus('[Iterator] No frequencies to iterate over')
+            return
+
         self.isFrequencyIteratorActive = True
 
-        self.iterator = FrequencyIterator()
-        self.iterator.emitFrequency.connect(self.setFrequency)
+        # One iterator per station, restarting only reschedules it
+        if self.iterator is None:
+            self.iterator = FrequencyIterator()
+            self.iterator.emitFrequency.connect(self.setFrequency)
+            self.iterator.emitSweep.connect(self.requestSweep)
 
-        if self.iteratorMode == IteratorMode.WithinPreset:
-            self.iterator.start(self.currentPreset['presetFrequencies'], self.frequency, self.iteratorDelay, implicitTrigger)
+        if self.isSweepEnabled and self.canSweep():
+            self.iterator.startSweep(self.iteratorFrequencies(), self.iteratorDelay)
+        else:
+            self.iterator.start(self.iteratorFrequencies(), self.frequency, self.iteratorDelay, implicitTrigger,
+                                self.iteratorAdaptiveThreshold())
 
-        elif self.iteratorMode == IteratorMode.ByStep:
-            list = []
-            for value in range(
+        self.setStationStatus('[Iterator] Started...')
+
+        self.syncUI()
+
+
+    def canSweep(self):
+        return self.antennaDriver is not None and self.antennaDriver.hardwareSweep
+
+
+    def canAdapt(self):
+        return self.adaptiveThreshold is not None
+
+
+    def iteratorAdaptiveThreshold(self):
+        # None for the plain round-robin iterator
+        return self.adaptiveThreshold if self.isAdaptiveEnabled and self.canAdapt() else None
+
+
+    def iteratorFrequencies(self):
+        # Ascending integer frequencies of the iterator mode and the
+        # partition, ByStep is a range so fine steps cost nothing to set up
+        if self.iteratorMode == IteratorMode.ByStep:
+            frequencies = range(
                 int(self.currentPreset["minFrequency"]),
                 int(self.currentPreset["maxFrequency"]),
                 self.frequencyStep
-            ):
-                list.append(str(value))
+            )
+        else:
+            frequencies = self.presetFrequencies
 
-            self.iterator.start(list, self.frequency, self.iteratorDelay, implicitTrigger)
+        if self.partition is None:
+            return frequencies
+        index, count, mode = self.partition
+        return partitionFrequencies(frequencies, index, count, mode == PartitionMode.Interleaved)
+
+
+    def isIteratorCoordinated(self):
+        # Active and driving a station that listens, see MainWidget.rebalanceStations
+        return self.isFrequencyIteratorActive and not self.isRemoteLocalModeActive
 
-        self.setStationStatus('[Iterator] Started...')
+
+    def setPartition(self, partition):
+        if partition == self.partition:
+            return
+        self.partition = partition
+
+        # Reschedule in place, the station stays active for the tower
+        # while it rebalances the others
+        if self.isFrequencyIteratorActive:
+            self.startIterator(False)
 
         self.syncUI()
 
 
+    def syncPartitionLabel(self):
+        if self.partition is None:
+            self.partitionLabel.setVisible(False)
+            return
+
+        index, count, mode = self.partition
+        frequencies = self.iteratorFrequencies()
+        if not frequencies:
+            coverage = 'empty'
+        elif mode == PartitionMode.Interleaved:
+            coverage = f'1 in {count} from {frequencies[0]} MHz'
+        else:
+            coverage = f'{frequencies[0]}-{frequencies[-1]} MHz'
+        self.partitionLabel.setText(f'Slice {index + 1}/{count}: {coverage}, {len(frequencies)} frequencies')
+        self.partitionLabel.setVisible(True)
+
+
+    @Slot(object)
+    def requestSweep(self, frequencies):
+        # Skip passes while a sweep is still being measured, unless it
+        # took much longer than expected
+        now = time.monotonic()
+        if self.sweepsInFlight:
+            if now < self.sweepDeadline:
+                return
+            self.setStationStatus('[Sweep] No answer, sweeping again')
+            self.sweepsInFlight = 0
+
+        expected = self.antenna.sweepDuration(frequencies) if self.antenna is not None else None
+        if expected is None:
+            expected = self.lastSweepDuration
+        self.sweepsInFlight += 1
+        self.sweepRequestedAt = now
+        self.sweepDeadline = now + expected + self.sweepTimeout
+
+        if self.isStationMode:
+            self.onSweepRequested.emit(frequencies)
+        else:
+            # The station does the sweep, see onRabbitFrequencyReceived
+            self.onSweepMessage.emit('sweep:' + ','.join(map(str, frequencies)))
+
+
+    def onSweepFinished(self):
+        if self.sweepsInFlight:
+            self.sweepsInFlight -= 1
+            self.lastSweepDuration = time.monotonic() - self.sweepRequestedAt
+
+
     def terminateIterator(self):
         self.isFrequencyIteratorActive = False
+        status = '[Iterator] Terminated'
         if self.iterator:
             self.iterator.stop()
-
-        self.setStationStatus('[Iterator] Terminated')
+            status += f', {self.iterator.jitter.summary()}'
+        if self.antenna is not None:
+            status += f'; antenna: {self.antenna.summary()}'
+        self.setStationStatus(status)
 
         self.syncUI()
 
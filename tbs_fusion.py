@@ -7,21 +7,63 @@
 
 
 import time
+import array
+import collections
 import ctypes
+import struct
 from enum import Enum
-from time import sleep
 
-from ppft.common import portnumber
 #from serial.serialwin32 import Serial as serial
 import serial
-from PySide6.QtSerialPort import QSerialPort, QSerialPortInfo
-from PySide6.QtCore import QIODevice, QTimer, QSettings
-from pycrc.algorithms import Crc
+from tbs_fusion_trace import TRACE_TX, TRACE_RX
 
 MSG_SYNC_VALUE_0 = 0xAA
 MSG_SYNC_VALUE_1 = 0x55
 
 
+def _make_crc16_ccitt_table(poly=0x1021):
+    """Build the 256-entry lookup table for a MSB-first CRC16"""
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ poly) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return tuple(table)
+
+
+_CRC16_CCITT_TABLE = _make_crc16_ccitt_table()
+
+
+def crc16_ccitt(data, crc=0xFFFF):
+    """Calculate the CRC16-CCITT-FALSE checksum of data
+
+    Table driven, one lookup per byte. Gives the same result as
+    pycrc's Crc(width=16, poly=0x1021, reflect_in=False, xor_in=0xFFFF,
+    reflect_out=False, xor_out=0x0000).bit_by_bit_fast().
+
+    Parameters
+    ----------
+    data : bytes-like
+        Data to calculate the checksum for.
+    crc : int
+        Initial value. Pass the result of a previous call to continue
+        the calculation over several buffers.
+
+    Returns
+    -------
+    crc : int
+        The 16 bit checksum.
+    """
+    table = _CRC16_CCITT_TABLE
+    for byte in data:
+        crc = ((crc << 8) & 0xFF00) ^ table[(crc >> 8) ^ byte]
+    return crc
+
+
 class MsgHeader(ctypes.Structure):
     _pack_ = 1
     _fields_ = [('sync_0', ctypes.c_uint8),
@@ -75,13 +117,479 @@ class MsgDataFreqListScan(ctypes.Structure):
                 ('delay_ms', ctypes.c_uint8)]
 
 
+# Precompiled encoders and decoders, little endian like the ctypes
+# structures above
+_HEADER = struct.Struct('<BBHBBB')
+_CRC = struct.Struct('<H')
+# Payloads of the messages, the wire format shared by TBSFusion,
+# AsyncTBSFusion and the simulator
+ACK_PAYLOAD = struct.Struct('<BB')
+FREQ_RSSI_PAYLOAD = struct.Struct('<HBB')
+SET_FREQ_PAYLOAD = struct.Struct('<H')
+RANGE_SCAN_PAYLOAD = struct.Struct('<HHBBB')
+LIST_SCAN_PAYLOAD = struct.Struct('<BB')
+
+# Offset of the data covered by the CRC: address, msg_type, length, payload
+_CRC_START = 4
+_MAX_PAYLOAD_LENGTH = 255
+
+# Payload length of the message types that have a fixed size. Used to
+# reject false sync bytes before waiting for the rest of a frame.
+_FIXED_PAYLOAD_LENGTH = {
+    MsgType.ACK.value: ACK_PAYLOAD.size,
+    MsgType.FREQUENCY_RSSI_REQUEST.value: 0,
+    MsgType.FREQUENCY_RSSI_RESPONSE.value: FREQ_RSSI_PAYLOAD.size,
+    MsgType.COMMAND_SET_FREQUENCY.value: SET_FREQ_PAYLOAD.size,
+    MsgType.FREQUENCY_RANGE_SCAN_REQUEST.value: RANGE_SCAN_PAYLOAD.size,
+}
+
+_MSG_TYPE_VALUES = frozenset(t.value for t in MsgType)
+
+# Encoders for frequency lists, by number of frequencies
+_freq_list_structs = {}
+
+
+def _freq_list_struct(num_freqs):
+    try:
+        return _freq_list_structs[num_freqs]
+    except KeyError:
+        packer = struct.Struct('<%dH' % num_freqs)
+        _freq_list_structs[num_freqs] = packer
+        return packer
+
+
+class FrameEncoder:
+    """
+    Builds frames in a preallocated buffer.
+
+    The frame returned by the encode methods is a memoryview into that
+    buffer and is only valid until the next frame is encoded.
+    """
+    def __init__(self):
+        self._buf = bytearray(_HEADER.size + _MAX_PAYLOAD_LENGTH)
+        self._view = memoryview(self._buf)
+        # Writable payload area
+        self.payload = self._view[_HEADER.size:]
+
+    def finish(self, address, msg_type, length):
+        """Complete the frame for the first length bytes of payload
+
+        Parameters
+        ----------
+        address : int
+            Address of the TBS Fusion.
+        msg_type : MsgType
+            Type of the message.
+        length : int
+            Number of payload bytes already written to self.payload.
+
+        Returns
+        -------
+        tx_data : memoryview
+            The frame, ready to be written to the serial port.
+        """
+        _HEADER.pack_into(self._buf, 0, MSG_SYNC_VALUE_0, MSG_SYNC_VALUE_1,
+                          0, address, msg_type.value, length)
+        end = _HEADER.size + length
+        _CRC.pack_into(self._buf, 2,
+                       crc16_ccitt(self._view[_CRC_START:end]))
+        return self._view[:end]
+
+    def encode(self, address, msg_type, msg_data=None):
+        """Encode a frame with the payload copied from msg_data"""
+        length = 0
+        if msg_data is not None:
+            msg_data = memoryview(msg_data).cast('B')
+            length = msg_data.nbytes
+            if length > _MAX_PAYLOAD_LENGTH:
+                raise ValueError('Payload too long: %d bytes' % length)
+            self.payload[:length] = msg_data
+        return self.finish(address, msg_type, length)
+
+    def encode_struct(self, address, msg_type, packer, *values):
+        """Encode a frame with the payload packed by a struct.Struct"""
+        packer.pack_into(self._buf, _HEADER.size, *values)
+        return self.finish(address, msg_type, packer.size)
+
+    def encode_list_scan(self, address, frequencies, rx_use, delay_ms):
+        """Encode a FREQUENCY_LIST_SCAN_REQUEST frame"""
+        num_freqs = len(frequencies)
+        length = LIST_SCAN_PAYLOAD.size + 2 * num_freqs
+        if length > _MAX_PAYLOAD_LENGTH:
+            raise ValueError('Too many frequencies for one scan: %d'
+                             % num_freqs)
+        LIST_SCAN_PAYLOAD.pack_into(self._buf, _HEADER.size, rx_use, delay_ms)
+        _freq_list_struct(num_freqs).pack_into(
+            self._buf, _HEADER.size + LIST_SCAN_PAYLOAD.size,
+            *[int(f) for f in frequencies])
+        return self.finish(address, MsgType.FREQUENCY_LIST_SCAN_REQUEST,
+                           length)
+
+
+def range_scan_data(freq_start, freq_stop, freq_step, rx_use, delay_ms):
+    """Payload of a FREQUENCY_RANGE_SCAN_REQUEST"""
+    return RANGE_SCAN_PAYLOAD.pack(freq_start, freq_stop, freq_step,
+                                   rx_use, delay_ms)
+
+
+def list_scan_data(frequencies, rx_use, delay_ms):
+    """Payload of a FREQUENCY_LIST_SCAN_REQUEST"""
+    return (LIST_SCAN_PAYLOAD.pack(rx_use, delay_ms)
+            + _freq_list_struct(len(frequencies)).pack(
+                *[int(f) for f in frequencies]))
+
+
+def scan_duration(num_freqs, rx_use, delay_ms):
+    """Approximate time in seconds the TBS Fusion needs for a scan"""
+    t_scan = 1e-3 * (delay_ms + 4) * num_freqs
+    if rx_use == 0:
+        t_scan = t_scan / 2
+    return t_scan
+
+
+# Largest number of frequencies in one scan. The response carries one
+# byte per frequency, a list scan request two bytes per frequency.
+MAX_RANGE_SCAN_FREQS = _MAX_PAYLOAD_LENGTH
+MAX_LIST_SCAN_FREQS = (_MAX_PAYLOAD_LENGTH - LIST_SCAN_PAYLOAD.size) // 2
+_MAX_FREQ_STEP = 255
+
+# Default settle time per frequency of range and list scans
+RANGE_SCAN_DELAY_MS = 25
+LIST_SCAN_DELAY_MS = 40
+
+
+def plan_sweep(frequencies, rx_use=0):
+    """Split a sweep into chunks that fit into one scan each
+
+    Parameters
+    ----------
+    frequencies : range or list (int)
+        Frequencies in MHz to measure, any number of them.
+    rx_use : int
+        Which receiver to use (0: both, 1: A, 2: B). When both receivers
+        are used the chunks have an even length, so the A/B interleaving
+        continues across chunk boundaries.
+
+    Returns
+    -------
+    chunks : list of range or list (int)
+        Consecutive parts of frequencies. A range chunk can be measured
+        with rssi_scan_range(), a list chunk with rssi_scan_list().
+    """
+    if (isinstance(frequencies, range) and 0 < frequencies.step
+            <= _MAX_FREQ_STEP):
+        max_freqs = MAX_RANGE_SCAN_FREQS
+    else:
+        frequencies = [int(f) for f in frequencies]
+        max_freqs = MAX_LIST_SCAN_FREQS
+
+    if rx_use == 0:
+        max_freqs -= max_freqs % 2
+
+    return [frequencies[i:i + max_freqs]
+            for i in range(0, len(frequencies), max_freqs)]
+
+
+def _chunk_delay_ms(chunk, delay_ms):
+    """Delay of a chunk from plan_sweep(), the scan default if None"""
+    if delay_ms is not None:
+        return delay_ms
+    if isinstance(chunk, range):
+        return RANGE_SCAN_DELAY_MS
+    return LIST_SCAN_DELAY_MS
+
+
+def sweep_duration(frequencies, rx_use=0, delay_ms=None):
+    """Approximate time in seconds TBSFusion.rssi_sweep() takes
+
+    Parameters are the same as for rssi_sweep(). The chunks are planned
+    the same way, so only the time between the scans is missing.
+    """
+    return sum(scan_duration(len(chunk), rx_use,
+                             _chunk_delay_ms(chunk, delay_ms))
+               for chunk in plan_sweep(frequencies, rx_use))
+
+
+# RSSI value scaled to 0..1, by raw value
+_RSSI_SCALE = tuple(x / 255 for x in range(256))
+
+
+class ScanResult:
+    """
+    RSSI measurements of a scan or sweep.
+
+    The raw uint8 values from the response are kept in one buffer and
+    all accessors are views of it. Scaling to 0..1 is done on demand.
+
+    When both receivers are used (rx_use=0) the receivers take turns:
+    the first frequency is measured by A, the second by B and so on, so
+    the values are interleaved (A, B, A, B, ..). rssi_a/frequencies_a
+    and rssi_b/frequencies_b are strided views of the values and
+    frequencies of each receiver.
+    """
+    def __init__(self, frequencies, raw, rx_use):
+        """
+        Parameters
+        ----------
+        frequencies : range or array.array
+            Frequencies in MHz, one per value.
+        raw : bytes-like
+            Raw RSSI values, 0..255.
+        rx_use : int
+            Which receiver was used (0: both, 1: A, 2: B).
+        """
+        self.frequencies = frequencies
+        self.raw = memoryview(raw).cast('B')
+        self.rx_use = rx_use
+
+    def __len__(self):
+        return len(self.raw)
+
+    def _receiver_slice(self, receiver):
+        if self.rx_use == 0:
+            return slice(receiver - 1, None, 2)
+        if self.rx_use == receiver:
+            return slice(None)
+        return slice(0)
+
+    def _frequencies(self, receiver):
+        frequencies = self.frequencies
+        if isinstance(frequencies, array.array):
+            frequencies = memoryview(frequencies)
+        return frequencies[self._receiver_slice(receiver)]
+
+    @property
+    def rssi_a(self):
+        """Raw values measured by receiver A"""
+        return self.raw[self._receiver_slice(1)]
+
+    @property
+    def rssi_b(self):
+        """Raw values measured by receiver B"""
+        return self.raw[self._receiver_slice(2)]
+
+    @property
+    def frequencies_a(self):
+        """Frequencies measured by receiver A"""
+        return self._frequencies(1)
+
+    @property
+    def frequencies_b(self):
+        """Frequencies measured by receiver B"""
+        return self._frequencies(2)
+
+    def scaled(self, values=None):
+        """RSSI scaled to 0..1
+
+        Parameters
+        ----------
+        values : bytes-like or None
+            Raw values to scale, e.g. rssi_a. If None, all values.
+
+        Returns
+        -------
+        rssi : array.array of float
+        """
+        if values is None:
+            values = self.raw
+        return array.array('d', map(_RSSI_SCALE.__getitem__, values))
+
+
+# Measured duration of a scan, compared to the scan_duration() estimate
+ScanTiming = collections.namedtuple(
+    'ScanTiming',
+    ['msg_type', 'num_freqs', 'rx_use', 'delay_ms', 'estimated', 'measured'])
+
+
+def sample_rssi(read_rssi, rate=None, average=1, stop=None):
+    """Generate RSSI samples by polling a receiver continuously
+
+    The next request is sent as soon as the previous response has been
+    parsed. The receiver has no averaging of its own, so each sample is
+    the mean of `average` back to back readings at the same frequency.
+    If the frequency changes while averaging, the readings so far are
+    discarded.
+
+    Parameters
+    ----------
+    read_rssi : callable
+        Returns (frequency, rssi_a, rssi_b), e.g.
+        TBSFusion.get_frequency_rssi.
+    rate : float or None
+        Target number of samples per second. If None, samples are
+        generated as fast as the link allows. A rate the link cannot
+        keep up with is not made up for later.
+    average : int
+        Number of readings averaged into one sample.
+    stop : threading.Event or None
+        The generator ends when the event is set. Waiting for the next
+        sample is cut short as well.
+
+    Yields
+    ------
+    timestamp : float
+        time.monotonic() of the last reading of the sample.
+    frequency : int
+        Operating frequency in MHz.
+    rssi_a, rssi_b : float
+        Mean RSSI of receiver A and B, scaled to 0..1.
+    """
+    period = 1.0 / rate if rate else 0.0
+    next_time = time.monotonic()
+    while stop is None or not stop.is_set():
+        num_readings = 0
+        while num_readings < average:
+            frequency, rssi_a, rssi_b = read_rssi()
+            if num_readings == 0 or frequency != sample_frequency:
+                sample_frequency = frequency
+                sum_a = sum_b = 0.0
+                num_readings = 0
+            sum_a += rssi_a
+            sum_b += rssi_b
+            num_readings += 1
+
+        timestamp = time.monotonic()
+        yield (timestamp, sample_frequency, sum_a / num_readings,
+               sum_b / num_readings)
+
+        if period:
+            next_time += period
+            delay = next_time - time.monotonic()
+            if delay <= 0:
+                next_time = time.monotonic()
+            elif stop is not None:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+
+
+class TBSFusionTimeout(RuntimeError):
+    """No complete response was received within the timeout"""
+
+
+class FrameParser:
+    """
+    Incremental parser that extracts TBS Fusion frames from a byte stream.
+
+    Data can be fed in chunks of any size, e.g. whatever a serial read
+    returned. The parser scans for the sync bytes, waits until the
+    complete frame is buffered, checks the header and the CRC and
+    resynchronizes on the next sync bytes if a frame is corrupt.
+    """
+    def __init__(self, size=1024):
+        """
+        Parameters
+        ----------
+        size : int
+            Initial size of the receive buffer in bytes. The buffer
+            grows if more data is fed than it can hold.
+        """
+        self._buf = bytearray(size)
+        self._view = memoryview(self._buf)
+        # Unparsed data is self._buf[self._head:self._tail]
+        self._head = 0
+        self._tail = 0
+        self._sync = bytes((MSG_SYNC_VALUE_0, MSG_SYNC_VALUE_1))
+
+        # Number of bytes skipped while searching for a valid frame
+        self.sync_errors = 0
+        # Number of frames dropped because of a CRC mismatch
+        self.crc_errors = 0
+
+    def __len__(self):
+        """Number of buffered bytes not parsed into a frame yet"""
+        return self._tail - self._head
+
+    def clear(self):
+        """Discard all buffered data"""
+        self._head = 0
+        self._tail = 0
+
+    def feed(self, data):
+        """Append received data to the buffer
+
+        Invalidates the payloads returned by frames().
+        """
+        n = len(data)
+        if self._tail + n > len(self._buf):
+            # Move the unparsed data to the start, grow if still too small
+            pending = self._tail - self._head
+            if pending + n > len(self._buf):
+                buf = bytearray(2 * (pending + n))
+                buf[:pending] = self._view[self._head:self._tail]
+                self._buf = buf
+                self._view = memoryview(buf)
+            else:
+                self._view[:pending] = self._view[self._head:self._tail]
+            self._head = 0
+            self._tail = pending
+        self._view[self._tail:self._tail + n] = data
+        self._tail += n
+
+    def _skip(self, n):
+        self._head += n
+        self.sync_errors += n
+
+    def frames(self):
+        """Yield all complete frames in the buffer
+
+        Yields
+        ------
+        address : int
+            Address of the TBS Fusion that sent the frame.
+        msg_type : int
+            Message type value, see MsgType.
+        msg_data : memoryview
+            The payload of the frame. Points into the receive buffer and
+            is only valid until the next call to feed(). Copy it if it
+            is needed for longer.
+        """
+        buf = self._buf
+        header_size = _HEADER.size
+        while self._tail - self._head >= header_size:
+            start = buf.find(self._sync, self._head, self._tail)
+            if start < 0:
+                # Keep the last byte, it can be the first sync byte
+                self._skip(self._tail - self._head - 1)
+                return
+            if start > self._head:
+                self._skip(start - self._head)
+                continue
+
+            _, _, crc, address, msg_type, length = _HEADER.unpack_from(
+                buf, start)
+            fixed_length = _FIXED_PAYLOAD_LENGTH.get(msg_type)
+            if (msg_type not in _MSG_TYPE_VALUES
+                    or fixed_length not in (None, length)):
+                # False sync bytes, search again from the next byte
+                self._skip(1)
+                continue
+
+            end = start + header_size + length
+            if end > self._tail:
+                # Wait for the rest of the frame
+                return
+
+            if crc16_ccitt(self._view[start + _CRC_START:end]) != crc:
+                self.crc_errors += 1
+                self._skip(1)
+                continue
+
+            self._head = end
+            yield address, msg_type, self._view[start + header_size:end]
+
+            if self._head == self._tail:
+                self._head = self._tail = 0
+
+
 class TBSFusion:
     """
     A class to control one or multiple TBS Fusion analog video
     receiver modules over a single wire or RS-485 serial connection.
     """
     def __init__(self, port, baudrate=115200, default_address=1,
-                 timeout=0.1, discard_echo=False, debug=True):
+                 timeout=0.1, discard_echo=False, debug=False, retries=2,
+                 ack_timeout=None, wakeup_preamble=None, trace=None):
         """
         Parameters
         ----------
@@ -102,18 +610,49 @@ class TBSFusion:
             enabled if the serial interface receives the data it sends.
         debug : bool
             Print debug information.
+        retries : int
+            Number of times a command is sent again if no ACK is
+            received for it.
+        ack_timeout : float or None
+            Timeout in seconds when waiting for an ACK. If None,
+            timeout is used.
+        wakeup_preamble : bytes or None
+            Bytes written in front of every frame, for receivers that
+            need to be woken up before they process a frame. They must
+            not contain the sync bytes.
+        trace : TraceRecorder or None
+            Records the raw data sent and received, see
+            tbs_fusion_trace. Cheaper than debug output.
         """
         self._timeout = timeout
+        self._retries = retries
+        self._ack_timeout = timeout if ack_timeout is None else ack_timeout
+        self._wakeup_preamble = wakeup_preamble
+        self._trace = trace
         self._default_address = default_address
         self._debug = debug
 
         # Discards the received data that has just been transmitted
         self._discard_echo = discard_echo
 
-        # Use CRC16_CCITT_FALSE
-        self._crc_alg = Crc(width=16, poly=0x1021,
-                            reflect_in=False, xor_in=0xFFFF,
-                            reflect_out=False, xor_out=0x0000)
+        # Received data is parsed incrementally, partial frames are
+        # kept until the rest arrives
+        self._parser = FrameParser()
+        # Frames are built in a preallocated buffer
+        self._encoder = FrameEncoder()
+        # Number of received frames not matching the expected response
+        self.stray_frames = 0
+
+        # Timing of the most recent scans, see ScanTiming
+        self.scan_timings = collections.deque(maxlen=100)
+
+        # Command statistics
+        self.commands_sent = 0
+        self.commands_first_attempt = 0
+        self.command_retries = 0
+        self.commands_failed = 0
+        # ACKs of retried commands received after the first one
+        self.late_acks_discarded = 0
 
         # Open the serial port
 
@@ -123,7 +662,7 @@ class TBSFusion:
         self._sio.parity = serial.PARITY_NONE
         self._sio.bytesize = serial.EIGHTBITS
         self._sio.stopbits = serial.STOPBITS_ONE
-        self._sio.timeout = 0.5
+        self._sio.timeout = timeout
         self._sio.xonxoff = False
         self._sio.rtscts = False
         self._sio.dsrdtr = False
@@ -149,132 +688,207 @@ class TBSFusion:
         self._sio.setStopBits(QSerialPort.StopBits.OneStop)
         self._sio.open(QIODevice.ReadWrite)
         '''
-    def _send_message(self, address, msg_type, msg_data=None):
-        """Send a message"""
-        if msg_data is not None:
-            msg_data = bytearray(msg_data)
-        else:
-            msg_data = bytearray()
-
-        if address is None:
-            address = self._default_address
-
-        # Create header
-        header = MsgHeader()
-        header.sync_0 = MSG_SYNC_VALUE_0
-        header.sync_1 = MSG_SYNC_VALUE_1
-        header.address = address
-        header.msg_type = msg_type.value
-        header.length = len(msg_data)
-
-        tx_data = bytearray(header)
-        tx_data.extend(bytearray(msg_data))
-
-        # Calculate CRC
-        header.crc = self._crc_alg.bit_by_bit_fast(tx_data[4:])
-
-        # Message with CRC
-        tx_data = bytearray(header)
-        tx_data.extend(bytearray(msg_data))
+    def close(self):
+        """Close the serial port"""
+        self._sio.close()
 
+    def _write_frame(self, tx_data, msg_type):
+        """Write an encoded frame to the serial port"""
         if self._debug:
+            _, _, crc, _, _, length = _HEADER.unpack_from(tx_data)
             print('TX MSG: %s data len: %d CRC: 0x%04X'
-                  % (msg_type.name, header.length, header.crc))
+                  % (msg_type.name, length, crc))
             print('Data: %s' % (' '.join('%02X' % x for x in tx_data)))
 
-        # Make sure input buffer is empty
-        self._sio.reset_input_buffer()
-
         # Send the data
-        #time.sleep(0.6)
-        n_sent = self._sio.write(tx_data)
-        n_sent = self._sio.write(tx_data) # in first time don't send data ((((
+        n_sent = 0
+        if self._wakeup_preamble:
+            n_sent += self._sio.write(self._wakeup_preamble)
+        n_sent += self._sio.write(tx_data)
         self._sio.flush()
 
+        if self._trace is not None:
+            if self._wakeup_preamble:
+                self._trace.record(TRACE_TX, self._wakeup_preamble)
+            self._trace.record(TRACE_TX, tx_data)
+
         if self._discard_echo:
             self._sio.read(n_sent)
 
-    def _receive_message(self, address, msg_type, payload_length,
-                         timeout=None):
-        """Receive a message"""
-        if timeout is not None:
-            # Change receive timeout for this message
-            self._sio.timeout = timeout
+    def _flush_input(self):
+        """Discard all received data that has not been parsed yet
 
-        total_length = ctypes.sizeof(MsgHeader) + payload_length
-        rx_data = self._sio.read(total_length)
+        Called before every request and after a timeout, so a late
+        response to an earlier exchange cannot be taken as the response
+        to the next one.
+        """
+        self._parser.clear()
+        self._sio.reset_input_buffer()
 
-        if self._debug:
-            print('RX: len: %d data: %s'
-                  % (len(rx_data), ' '.join('%02X' % x for x in rx_data)))
-
-        if timeout is not None:
-            # Change it back to original setting
-            self._sio.timeout = self._timeout
-
-        if rx_data is None or len(rx_data) < 2:
-            raise RuntimeError('No data received')
-
-        # Check sync bytes
-        if rx_data[0] != MSG_SYNC_VALUE_0 or rx_data[1] != MSG_SYNC_VALUE_1:
-            raise RuntimeError('Sync bytes invalid: %s'
-                               % ' '.join('%02X' % x for x in rx_data[:2]))
-
-        if len(rx_data) < ctypes.sizeof(MsgHeader):
-            raise RuntimeError('Received data is too short (%d bytes)'
-                               % len(rx_data))
-
-        # Decode the message
-        rx_header = MsgHeader.from_buffer_copy(rx_data)
-        needed_length = ctypes.sizeof(MsgHeader) + rx_header.length
-        if len(rx_data) < needed_length:
-            raise RuntimeError('Received data is too short: %d bytes.'
-                               'Expected from header: %d bytes'
-                               % (len(rx_data), needed_length))
-
-        # Calculate and check CRC
-        crc = self._crc_alg.bit_by_bit_fast(rx_data[4:needed_length])
-
-        if crc != rx_header.crc:
-            raise RuntimeError('CRC check failed. Header: 0x%04X '
-                               'Calculated: 0x%04X' % (rx_header.crc, crc))
-
-        msg_data = rx_data[ctypes.sizeof(MsgHeader):]
-        # Check if it is an ACK message with an error code:
-        if rx_header.msg_type == MsgType.ACK.value and msg_data[1] != 0:
-            raise RuntimeError('Received error code %d' % msg_data[1])
-
-        # Check address
+    def _send_message(self, address, msg_type, msg_data=None):
+        """Send a message"""
         if address is None:
             address = self._default_address
-        if rx_header.address != address:
-            raise RuntimeError('Incorrect address received: %d' % address)
 
-        # Check message type
-        if rx_header.msg_type != msg_type.value:
-            raise RuntimeError('Incorrect message type received.'
-                               'Expected %d received %d'
-                               % (msg_type.value, rx_header.msg_type))
+        self._flush_input()
+        self._write_frame(self._encoder.encode(address, msg_type, msg_data),
+                          msg_type)
 
-        if len(msg_data) < payload_length:
-            raise RuntimeError('Payload data too short. '
-                               'Expected: %d bytes. Received %d bytes'
-                               % (payload_length, len(msg_data)))
+    def _receive_message(self, address, msg_type, payload_length,
+                         timeout=None, progress=None):
+        """Receive a message
+
+        Reads whatever the port has available and feeds it to the frame
+        parser until a frame from the given address with the given
+        message type and exactly payload_length bytes of payload is
+        complete. Other frames are skipped. On a timeout, the data
+        received so far is discarded. If given, progress(received, expected) is
+        called with the number of bytes buffered after every read.
+        """
+        if timeout is None:
+            timeout = self._timeout
 
-        return msg_data
+        if address is None:
+            address = self._default_address
 
-    def _check_ack(self, address, msg_type):
+        # Changing the port timeout reconfigures the port, so it is only
+        # done when a message needs another timeout. Reads block for the
+        # whole timeout, a frame that stops arriving midway can delay the
+        # timeout by up to that long.
+        self._set_port_timeout(timeout)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                for rx_address, rx_msg_type, msg_data in \
+                        self._parser.frames():
+                    if self._debug:
+                        print('RX: len: %d data: %s'
+                              % (len(msg_data),
+                                 ' '.join('%02X' % x for x in msg_data)))
+
+                    # Check if it is an ACK message with an error code:
+                    if (rx_address == address
+                            and rx_msg_type == MsgType.ACK.value
+                            and msg_data[1] != 0):
+                        raise RuntimeError('Received error code %d'
+                                           % msg_data[1])
+
+                    # Check address, message type and length. A scan
+                    # response of another length belongs to another
+                    # request.
+                    if (rx_address != address
+                            or rx_msg_type != msg_type.value
+                            or len(msg_data) != payload_length):
+                        self.stray_frames += 1
+                        if self._debug:
+                            print('Skipping frame: address %d msg_type %d '
+                                  'length %d' % (rx_address, rx_msg_type,
+                                                 len(msg_data)))
+                        continue
+
+                    # Only valid until the parser is fed again
+                    return msg_data
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    pending = len(self._parser)
+                    self._flush_input()
+                    if pending == 0:
+                        raise TBSFusionTimeout('No data received')
+                    raise TBSFusionTimeout('Incomplete message received '
+                                           '(%d bytes pending)' % pending)
+
+                # Block until at least one byte arrives, then take
+                # everything that is already waiting
+                rx_data = self._sio.read(max(1, self._sio.in_waiting))
+                if rx_data:
+                    if self._trace is not None:
+                        self._trace.record(TRACE_RX, rx_data)
+                    self._parser.feed(rx_data)
+                    if progress is not None:
+                        progress(len(self._parser),
+                                 _HEADER.size + payload_length)
+        finally:
+            self._set_port_timeout(self._timeout)
+
+    def _set_port_timeout(self, timeout):
+        """Set the read timeout of the port if it is not set already"""
+        if self._sio.timeout != timeout:
+            self._sio.timeout = timeout
+
+    def _check_ack(self, address, msg_type, timeout=None):
         """Check for ACK message and error code"""
         msg_data = self._receive_message(address, MsgType.ACK,
-                                         ctypes.sizeof(MsgDataAck))
-        ack = MsgDataAck.from_buffer_copy(msg_data)
-        if ack.msg_type != msg_type.value:
+                                         ACK_PAYLOAD.size, timeout=timeout)
+        ack_msg_type, error_code = ACK_PAYLOAD.unpack_from(msg_data)
+        if ack_msg_type != msg_type.value:
             raise RuntimeError('ACK for different msg_type received.'
                                'Expected %d received %d'
-                               % (msg_type.value, ack.msg_type))
+                               % (msg_type.value, ack_msg_type))
+
+        if error_code != 0:
+            raise RuntimeError('Received error code %d' % (error_code))
+
+    def _send_command(self, address, msg_type, tx_data):
+        """Send an encoded command frame and wait for the ACK
+
+        The command is sent again if no ACK arrives within the ACK
+        timeout, up to the configured number of retries. Error codes
+        reported by the receiver are raised without retrying.
 
-        if ack.error_code != 0:
-            raise RuntimeError('Received error code %d' % (ack.error_code))
+        Input is discarded before every attempt. Once an ACK is
+        received, the ACKs still expected for the other attempts are
+        waited for and discarded, so they cannot confirm the next
+        command.
+        """
+        self.commands_sent += 1
+        t_first = time.monotonic()
+        for attempt in range(self._retries + 1):
+            self._flush_input()
+            self._write_frame(tx_data, msg_type)
+            try:
+                self._check_ack(address, msg_type, timeout=self._ack_timeout)
+            except TBSFusionTimeout:
+                if attempt == self._retries:
+                    self.commands_failed += 1
+                    raise
+                self.command_retries += 1
+                if self._debug:
+                    print('No ACK for %s, retrying' % msg_type.name)
+                continue
+            except RuntimeError:
+                self._discard_late_acks(address, msg_type, attempt, t_first)
+                raise
+
+            if attempt == 0:
+                self.commands_first_attempt += 1
+            else:
+                self._discard_late_acks(address, msg_type, attempt, t_first)
+            return
+
+    def _discard_late_acks(self, address, msg_type, count, t_first):
+        """Wait for and drop up to count ACKs of earlier attempts
+
+        The ACK just received took at most the time since the first
+        attempt was sent, the ACKs of later attempts are expected within
+        the same time from now. ACKs that were lost are not waited for
+        any longer than that.
+        """
+        now = time.monotonic()
+        deadline = now + (now - t_first)
+        while count > 0:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self._check_ack(address, msg_type, timeout=remaining)
+            except TBSFusionTimeout:
+                break
+            except RuntimeError:
+                # Error code of a duplicate, already reported
+                pass
+            count -= 1
+            self.late_acks_discarded += 1
 
     def set_frequency(self, frequency, address=None):
         """Set the operating frequency
@@ -286,13 +900,13 @@ class TBSFusion:
         address : int or None
             Address of the TBS Fusion. If None, the default_address is used.
         """
-        freq_data = MsgDataSetFreq()
-        freq_data.frequency = frequency
+        if address is None:
+            address = self._default_address
 
-        #time.sleep(0.1)
-        self._send_message(address, MsgType.COMMAND_SET_FREQUENCY, freq_data)
-        #time.sleep(0.1)
-        self._check_ack(address, MsgType.COMMAND_SET_FREQUENCY)
+        tx_data = self._encoder.encode_struct(
+            address, MsgType.COMMAND_SET_FREQUENCY, SET_FREQ_PAYLOAD,
+            frequency)
+        self._send_command(address, MsgType.COMMAND_SET_FREQUENCY, tx_data)
 
     def get_frequency_rssi(self, address=None):
         """Get the current operating frequency and RSSI
@@ -315,21 +929,77 @@ class TBSFusion:
         """
         self._send_message(address, MsgType.FREQUENCY_RSSI_REQUEST)
 
-        sleep(0.2)
         msg_data = self._receive_message(address,
                                          MsgType.FREQUENCY_RSSI_RESPONSE,
-                                         ctypes.sizeof(MsgDataFreqRssi))
+                                         FREQ_RSSI_PAYLOAD.size)
 
-        freq_rssi = MsgDataFreqRssi.from_buffer_copy(msg_data)
+        frequency, rssi_a, rssi_b = FREQ_RSSI_PAYLOAD.unpack_from(msg_data)
 
         # Scale to 0..1 range
-        rssi_a = float(freq_rssi.rssi_a) / 255
-        rssi_b = float(freq_rssi.rssi_b) / 255
+        rssi_a = float(rssi_a) / 255
+        rssi_b = float(rssi_b) / 255
+
+        return frequency, rssi_a, rssi_b
+
+    def stream_rssi(self, rate=None, average=1, address=None, stop=None):
+        """Measure the RSSI continuously
+
+        See sample_rssi(). The caller must not send other requests to
+        the port while iterating, use a FusionBus to share it.
+
+        Parameters
+        ----------
+        rate : float or None
+            Target number of samples per second. If None, as fast as
+            the link allows.
+        average : int
+            Number of readings averaged into one sample.
+        address : int or None
+            Address of the TBS Fusion. If None, the default_address is used.
+        stop : threading.Event or None
+            Ends the stream when set.
+
+        Returns
+        -------
+        samples : generator
+            Yields (timestamp, frequency, rssi_a, rssi_b) tuples.
+        """
+        if address is None:
+            address = self._default_address
+
+        return sample_rssi(lambda: self.get_frequency_rssi(address), rate,
+                           average, stop)
 
-        return freq_rssi.frequency, rssi_a, rssi_b
+    def _scan(self, address, msg_type, tx_data, num_freqs, rx_use, delay_ms,
+              timeout, progress):
+        """Send a scan request and wait for the response
+
+        Returns as soon as the response is complete. The time it took is
+        added to scan_timings.
+        """
+        estimated = scan_duration(num_freqs, rx_use, delay_ms)
+
+        self._flush_input()
+        t_start = time.monotonic()
+        self._write_frame(tx_data, msg_type)
+        rssi_data = self._receive_message(address,
+                                          MsgType.FREQUENCY_SCAN_RESPONSE,
+                                          num_freqs,
+                                          timeout=estimated + timeout,
+                                          progress=progress)
+        measured = time.monotonic() - t_start
+
+        self.scan_timings.append(ScanTiming(msg_type, num_freqs, rx_use,
+                                            delay_ms, estimated, measured))
+        if self._debug:
+            print('Scan of %d frequencies took %0.3f s, estimated %0.3f s'
+                  % (num_freqs, measured, estimated))
+
+        return rssi_data
 
     def rssi_scan_range(self, freq_start, freq_stop, freq_step, rx_use=0,
-                        delay_ms=25, timeout=1.0, address=None):
+                        delay_ms=RANGE_SCAN_DELAY_MS, timeout=1.0,
+                        address=None, progress=None):
         """Measure the RSSI for a frequency range
 
         Parameters
@@ -346,49 +1016,40 @@ class TBSFusion:
             Delay in milliseconds between setting frequency and measuring
             RSSI. Needs to be large enough for RSSI to stabilize.
         timeout : float
-            Additional timeout to use when waiting for response.
+            Additional timeout to use when waiting for response. The scan
+            fails if the response is not complete after the approximate
+            scan time plus timeout.
         address : int or None
             Address of the TBS Fusion. If None, the default_address is used.
+        progress : callable or None
+            Called as progress(received, expected) with the number of
+            response bytes received so far.
 
         Returns
         -------
-        frequencies : list (int)
-            List of frequencies in MHz at which the RSSI was acquired.
-        RSSI : list (float)
-            RSSI measurements. Note: When both receivers are used, the
-            values are interleaved (A, B, A, B, ..).
+        result : ScanResult
+            The measurements, with frequencies being the range of
+            frequencies at which the RSSI was acquired.
         """
-        freq_range_scan = MsgDataFreqRangeScan()
-        freq_range_scan.freq_start = freq_start
-        freq_range_scan.freq_stop = freq_stop
-        freq_range_scan.freq_step = freq_step
-        freq_range_scan.rx_use = rx_use
-        freq_range_scan.delay_ms = delay_ms
-
-        self._send_message(address, MsgType.FREQUENCY_RANGE_SCAN_REQUEST,
-                           freq_range_scan)
+        if address is None:
+            address = self._default_address
 
         # These are the actual frequencies used
-        frequencies = list(range(freq_start, freq_stop, freq_step))
+        frequencies = range(freq_start, freq_stop, freq_step)
         num_freqs = len(frequencies)
 
-        # Approximate time needed
-        t_scan = 1e-3 * (delay_ms + 4) * num_freqs
-        if rx_use == 0:
-            t_scan = t_scan / 2
-        time.sleep(t_scan)
+        tx_data = self._encoder.encode_struct(
+            address, MsgType.FREQUENCY_RANGE_SCAN_REQUEST, RANGE_SCAN_PAYLOAD,
+            freq_start, freq_stop, freq_step, rx_use, delay_ms)
+        rssi_data = self._scan(address, MsgType.FREQUENCY_RANGE_SCAN_REQUEST,
+                               tx_data, num_freqs, rx_use, delay_ms, timeout,
+                               progress)
 
-        rssi_data = self._receive_message(address,
-                                          MsgType.FREQUENCY_SCAN_RESPONSE,
-                                          num_freqs, timeout=timeout)
+        return ScanResult(frequencies, bytes(rssi_data[:num_freqs]), rx_use)
 
-        # Scale to 0..1 range
-        rssi = [float(x) / 255 for x in rssi_data]
-
-        return frequencies, rssi
-
-    def rssi_scan_list(self, frequencies, rx_use=0, delay_ms=40,
-                       timeout=1.0, address=None):
+    def rssi_scan_list(self, frequencies, rx_use=0,
+                       delay_ms=LIST_SCAN_DELAY_MS, timeout=1.0,
+                       address=None, progress=None):
         """Measure the RSSI for a list of frequencies
 
         Parameters
@@ -401,41 +1062,95 @@ class TBSFusion:
             Delay in milliseconds between setting frequency and measuring
             RSSI. Needs to be large enough for RSSI to stabilize.
         timeout : float
-            Additional timeout to use when waiting for response.
+            Additional timeout to use when waiting for response. The scan
+            fails if the response is not complete after the approximate
+            scan time plus timeout.
         address : int or None
             Address of the TBS Fusion. If None, the default_address is used.
+        progress : callable or None
+            Called as progress(received, expected) with the number of
+            response bytes received so far.
 
         Returns
         -------
-        RSSI : list (float)
-            RSSI measurements. Note: When both receivers are used, the
-            values are interleaved (A, B, A, B, ..).
+        result : ScanResult
+            The measurements.
         """
-        num_freqs = len(frequencies)
-        freq_array_type = ctypes.c_uint16 * num_freqs
-        freq_array = freq_array_type(*[int(f) for f in frequencies])
+        if address is None:
+            address = self._default_address
 
-        freq_list_scan = MsgDataFreqListScan()
-        freq_list_scan.rx_use = rx_use
-        freq_list_scan.delay_ms = delay_ms
+        num_freqs = len(frequencies)
+        tx_data = self._encoder.encode_list_scan(address, frequencies, rx_use,
+                                                 delay_ms)
+        rssi_data = self._scan(address, MsgType.FREQUENCY_LIST_SCAN_REQUEST,
+                               tx_data, num_freqs, rx_use, delay_ms, timeout,
+                               progress)
 
-        msg_data = bytearray(freq_list_scan)
-        msg_data.extend(bytearray(freq_array))
+        return ScanResult(array.array('H', frequencies),
+                          bytes(rssi_data[:num_freqs]), rx_use)
 
-        self._send_message(address, MsgType.FREQUENCY_LIST_SCAN_REQUEST,
-                           msg_data)
+    def rssi_sweep(self, frequencies, rx_use=0, delay_ms=None, timeout=1.0,
+                   address=None, progress=None):
+        """Measure the RSSI for any number of frequencies
 
-        # Approximate time needed
-        t_scan = 1e-3 * (delay_ms + 4) * num_freqs
-        if rx_use == 0:
-            t_scan = t_scan / 2
-        time.sleep(t_scan)
+        The frequencies are split into chunks that fit into one scan
+        (see plan_sweep()) and the chunks are scanned back to back.
 
-        rssi_data = self._receive_message(address,
-                                          MsgType.FREQUENCY_SCAN_RESPONSE,
-                                          num_freqs, timeout=timeout)
+        Parameters
+        ----------
+        frequencies : range or list (int)
+            Frequencies in MHz at which the RSSI will be acquired. A range
+            with a step of up to 255 MHz is measured with range scans,
+            anything else with list scans.
+        rx_use : int
+            Which receiver to use (0: both, 1: A, 2: B).
+        delay_ms : int or None
+            Delay in milliseconds between setting frequency and measuring
+            RSSI. If None, the default of the scan method is used.
+        timeout : float
+            Additional timeout for each chunk, see rssi_scan_list().
+        address : int or None
+            Address of the TBS Fusion. If None, the default_address is used.
+        progress : callable or None
+            Called as progress(done, total) with the number of frequencies
+            measured so far after each chunk.
 
-        # Scale to 0..1 range
-        rssi = [float(x) / 255 for x in rssi_data]
+        Returns
+        -------
+        result : ScanResult
+            The measurements of all chunks in one buffer. frequencies is
+            the given range, or an array of the given frequencies.
+        """
+        if address is None:
+            address = self._default_address
 
-        return rssi
+        chunks = plan_sweep(frequencies, rx_use)
+        if not chunks or not isinstance(chunks[0], range):
+            frequencies = array.array('H', [int(f) for f in frequencies])
+
+        total = len(frequencies)
+        raw = bytearray(total)
+        done = 0
+        for chunk in chunks:
+            num_freqs = len(chunk)
+            if isinstance(chunk, range):
+                msg_type = MsgType.FREQUENCY_RANGE_SCAN_REQUEST
+                chunk_delay_ms = _chunk_delay_ms(chunk, delay_ms)
+                tx_data = self._encoder.encode_struct(
+                    address, msg_type, RANGE_SCAN_PAYLOAD, chunk.start,
+                    chunk.stop, chunk.step, rx_use, chunk_delay_ms)
+            else:
+                msg_type = MsgType.FREQUENCY_LIST_SCAN_REQUEST
+                chunk_delay_ms = _chunk_delay_ms(chunk, delay_ms)
+                tx_data = self._encoder.encode_list_scan(
+                    address, chunk, rx_use, chunk_delay_ms)
+
+            rssi_data = self._scan(address, msg_type, tx_data, num_freqs,
+                                   rx_use, chunk_delay_ms, timeout, None)
+            raw[done:done + num_freqs] = rssi_data[:num_freqs]
+            done += num_freqs
+
+            if progress is not None:
+                progress(done, total)
+
+        return ScanResult(frequencies, raw, rx_use)
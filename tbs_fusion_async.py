@@ -0,0 +1,388 @@
+"""Asyncio interface to the TBS Fusion over a serial connection"""
+
+import array
+import asyncio
+import collections
+
+import serial_asyncio
+
+from tbs_fusion import (FrameEncoder, FrameParser, MsgType, ScanResult,
+                        TBSFusionTimeout,
+                        range_scan_data, list_scan_data, scan_duration,
+                        RANGE_SCAN_DELAY_MS, LIST_SCAN_DELAY_MS,
+                        ACK_PAYLOAD, FREQ_RSSI_PAYLOAD, SET_FREQ_PAYLOAD)
+from tbs_fusion_trace import TRACE_TX, TRACE_RX
+
+
+# Message type of the response to each request
+_RESPONSE_TYPE = {
+    MsgType.COMMAND_SET_FREQUENCY.value: MsgType.ACK.value,
+    MsgType.FREQUENCY_RSSI_REQUEST.value:
+        MsgType.FREQUENCY_RSSI_RESPONSE.value,
+    MsgType.FREQUENCY_RANGE_SCAN_REQUEST.value:
+        MsgType.FREQUENCY_SCAN_RESPONSE.value,
+    MsgType.FREQUENCY_LIST_SCAN_REQUEST.value:
+        MsgType.FREQUENCY_SCAN_RESPONSE.value,
+}
+
+
+class _FusionProtocol(asyncio.Protocol):
+    """Feeds the data received on the serial transport to AsyncTBSFusion"""
+    def __init__(self, fusion):
+        self._fusion = fusion
+
+    def connection_made(self, transport):
+        self._fusion._transport = transport
+
+    def data_received(self, data):
+        self._fusion._data_received(data)
+
+    def connection_lost(self, exc):
+        self._fusion._connection_lost(exc)
+
+
+class AsyncTBSFusion:
+    """
+    Asyncio version of TBSFusion.
+
+    Nothing blocks while waiting for the receiver: received data is
+    parsed as it arrives and each response completes the request that
+    is waiting for it. Requests to different addresses, or several
+    requests to the same address, can be awaited at the same time,
+    each with its own timeout. They are sent one exchange at a time, in
+    the order they were made, so receivers on a half-duplex RS-485 bus
+    never answer at the same time.
+
+    Use AsyncTBSFusion.open() to create an instance.
+    """
+    def __init__(self, default_address=1, timeout=0.1, retries=2,
+                 debug=False, trace=None):
+        """
+        Parameters
+        ----------
+        default_address : int
+            Address to use for TBS Fusion if not provided
+            when calling methods.
+        timeout : float
+            Default timeout in seconds when waiting for responses.
+        retries : int
+            Number of times a command is sent again if no ACK is
+            received for it.
+        debug : bool
+            Print debug information.
+        trace : TraceRecorder or None
+            Records the raw data sent and received, see
+            tbs_fusion_trace.
+        """
+        self._default_address = default_address
+        self._timeout = timeout
+        self._retries = retries
+        self._debug = debug
+        self._trace = trace
+
+        self._transport = None
+        self._parser = FrameParser()
+        # Frames are built in a preallocated buffer
+        self._encoder = FrameEncoder()
+        # Futures waiting for a response and the payload length they
+        # expect, by (address, response type)
+        self._waiters = collections.defaultdict(collections.deque)
+        # Held for a whole exchange, including the retries of a command
+        self._exchange_lock = asyncio.Lock()
+
+        # Number of received frames nobody was waiting for
+        self.stray_frames = 0
+        # ACKs of retried commands received after the first one
+        self.late_acks_discarded = 0
+
+    @classmethod
+    async def open(cls, port, baudrate=115200, **kwargs):
+        """Open the serial port and return a connected instance
+
+        Parameters
+        ----------
+        port : str
+            Serial port to use. E.g. 'COM1' or '/dev/ttyUSB0'.
+        baudrate : int
+            Baudrate to use for serial connection.
+        **kwargs
+            Passed to AsyncTBSFusion().
+        """
+        fusion = cls(**kwargs)
+        loop = asyncio.get_running_loop()
+        # connection_made() is only called on the next loop iteration,
+        # take the transport from here so requests can be sent at once
+        fusion._transport, _ = await serial_asyncio.create_serial_connection(
+            loop, lambda: _FusionProtocol(fusion), port, baudrate=baudrate)
+        return fusion
+
+    def close(self):
+        """Close the serial port"""
+        if self._transport is not None:
+            self._transport.close()
+
+    def _data_received(self, data):
+        if self._trace is not None:
+            self._trace.record(TRACE_RX, data)
+        self._parser.feed(data)
+        for rx_address, rx_msg_type, msg_data in self._parser.frames():
+            if self._debug:
+                print('RX: address: %d msg_type: %d data: %s'
+                      % (rx_address, rx_msg_type,
+                         ' '.join('%02X' % x for x in msg_data)))
+
+            error = None
+            response_type = rx_msg_type
+            if rx_msg_type == MsgType.ACK.value:
+                ack_msg_type, error_code = ACK_PAYLOAD.unpack_from(msg_data)
+                if error_code != 0:
+                    # The request failed, wake up whoever waits for
+                    # its response
+                    error = RuntimeError('Received error code %d'
+                                         % error_code)
+                    response_type = _RESPONSE_TYPE.get(ack_msg_type,
+                                                       response_type)
+
+            waiters = self._waiters.get((rx_address, response_type))
+            while waiters and waiters[0][0].done():
+                # Timed out or cancelled
+                waiters.popleft()
+            if not waiters:
+                self.stray_frames += 1
+                continue
+
+            future, payload_length = waiters[0]
+            if error is None and len(msg_data) != payload_length:
+                # A scan response of another length belongs to another
+                # request
+                self.stray_frames += 1
+                if self._debug:
+                    print('Skipping frame: address %d msg_type %d '
+                          'length %d' % (rx_address, rx_msg_type,
+                                         len(msg_data)))
+                continue
+
+            waiters.popleft()
+            if error is not None:
+                future.set_exception(error)
+            else:
+                # The parser reuses its buffer
+                future.set_result(bytes(msg_data))
+
+    def _connection_lost(self, exc):
+        error = exc or ConnectionError('Serial port closed')
+        for waiters in self._waiters.values():
+            for future, _ in waiters:
+                if not future.done():
+                    future.set_exception(error)
+        self._waiters.clear()
+        self._transport = None
+
+    async def _request(self, address, msg_type, msg_data, payload_length,
+                       timeout):
+        """Send a message and wait for the response to it"""
+        async with self._exchange_lock:
+            return await self._exchange(address, msg_type, msg_data,
+                                        payload_length, timeout)
+
+    async def _exchange(self, address, msg_type, msg_data, payload_length,
+                        timeout):
+        """Like _request(), the caller holds the exchange lock"""
+        if address is None:
+            address = self._default_address
+        if self._transport is None:
+            raise ConnectionError('Serial port is not open')
+
+        key = (address, _RESPONSE_TYPE[msg_type.value])
+        future = self._expect(key, payload_length)
+
+        # A partial frame left by an earlier exchange is not completed
+        # by the response to this one
+        self._parser.clear()
+        # The transport keeps a reference to data it could not write
+        # yet, so the frame is copied out of the shared buffer once
+        tx_data = bytes(self._encoder.encode(address, msg_type, msg_data))
+        if self._debug:
+            print('TX MSG: %s data: %s'
+                  % (msg_type.name, ' '.join('%02X' % x for x in tx_data)))
+        self._transport.write(tx_data)
+        if self._trace is not None:
+            self._trace.record(TRACE_TX, tx_data)
+
+        try:
+            return await self._wait(key, future, timeout)
+        except TBSFusionTimeout:
+            raise TBSFusionTimeout('No response to %s within %0.3f s'
+                                   % (msg_type.name, timeout)) from None
+
+    def _expect(self, key, payload_length):
+        """Register a future for the next response matching key"""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[key].append((future, payload_length))
+        return future
+
+    async def _wait(self, key, future, timeout):
+        """Wait for a future from _expect(), unregistering it after"""
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TBSFusionTimeout('No response within %0.3f s'
+                                   % timeout) from None
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters:
+                for waiter in waiters:
+                    if waiter[0] is future:
+                        waiters.remove(waiter)
+                        break
+
+    async def _discard_late_acks(self, address, count, t_first, timeout):
+        """Wait for and drop up to count ACKs of earlier attempts
+
+        Like TBSFusion._discard_late_acks(), but there is no input
+        buffer to flush before the next command, so an ACK that is
+        still on its way would confirm it. ACKs are waited for one
+        more timeout than the time the first one took.
+        """
+        if address is None:
+            address = self._default_address
+        key = (address, MsgType.ACK.value)
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        deadline = now + (now - t_first) + timeout
+        while count > 0:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            future = self._expect(key, ACK_PAYLOAD.size)
+            try:
+                await self._wait(key, future, remaining)
+            except TBSFusionTimeout:
+                break
+            except RuntimeError:
+                # Error code of a duplicate, already reported
+                pass
+            count -= 1
+            self.late_acks_discarded += 1
+
+    async def set_frequency(self, frequency, address=None, timeout=None):
+        """Set the operating frequency
+
+        Parameters
+        ----------
+        frequency : int
+            Frequency in MHz.
+        address : int or None
+            Address of the TBS Fusion. If None, the default_address is used.
+        timeout : float or None
+            Timeout in seconds for each attempt. If None, the default
+            timeout is used.
+        """
+        if timeout is None:
+            timeout = self._timeout
+
+        freq_data = SET_FREQ_PAYLOAD.pack(frequency)
+
+        # Every attempt answered gets an ACK, the ones for the other
+        # attempts are discarded before the next exchange
+        async with self._exchange_lock:
+            t_first = asyncio.get_running_loop().time()
+            for attempt in range(self._retries + 1):
+                try:
+                    msg_data = await self._exchange(
+                        address, MsgType.COMMAND_SET_FREQUENCY, freq_data,
+                        ACK_PAYLOAD.size, timeout)
+                except TBSFusionTimeout:
+                    if attempt == self._retries:
+                        raise
+                    continue
+                except RuntimeError:
+                    await self._discard_late_acks(address, attempt, t_first,
+                                                  timeout)
+                    raise
+                if attempt > 0:
+                    await self._discard_late_acks(address, attempt, t_first,
+                                                  timeout)
+                break
+
+        ack_msg_type, _ = ACK_PAYLOAD.unpack_from(msg_data)
+        if ack_msg_type != MsgType.COMMAND_SET_FREQUENCY.value:
+            raise RuntimeError('ACK for different msg_type received.'
+                               'Expected %d received %d'
+                               % (MsgType.COMMAND_SET_FREQUENCY.value,
+                                  ack_msg_type))
+
+    async def get_frequency_rssi(self, address=None, timeout=None):
+        """Get the current operating frequency and RSSI
+
+        Parameters
+        ----------
+        address : int or None
+            Address of the TBS Fusion. If None, the default_address is used.
+        timeout : float or None
+            Timeout in seconds. If None, the default timeout is used.
+
+        Returns
+        -------
+        frequency : int
+            Operating frequency in MHz.
+        RSSI A: float.
+            Received signal strength indicator for receiver A.
+            Scaled to 0..1.
+        RSSI B: float.
+            Received signal strength indicator for receiver B.
+            Scaled to 0..1.
+        """
+        if timeout is None:
+            timeout = self._timeout
+
+        msg_data = await self._request(address,
+                                       MsgType.FREQUENCY_RSSI_REQUEST, None,
+                                       FREQ_RSSI_PAYLOAD.size, timeout)
+
+        frequency, rssi_a, rssi_b = FREQ_RSSI_PAYLOAD.unpack_from(msg_data)
+
+        # Scale to 0..1 range
+        rssi_a = float(rssi_a) / 255
+        rssi_b = float(rssi_b) / 255
+
+        return frequency, rssi_a, rssi_b
+
+    async def rssi_scan_range(self, freq_start, freq_stop, freq_step,
+                              rx_use=0, delay_ms=RANGE_SCAN_DELAY_MS,
+                              timeout=1.0, address=None):
+        """Measure the RSSI for a frequency range
+
+        See TBSFusion.rssi_scan_range(). The response is awaited for the
+        approximate scan time plus timeout.
+        """
+        freq_range_scan = range_scan_data(freq_start, freq_stop, freq_step,
+                                          rx_use, delay_ms)
+
+        # These are the actual frequencies used
+        frequencies = range(freq_start, freq_stop, freq_step)
+        num_freqs = len(frequencies)
+
+        rssi_data = await self._request(
+            address, MsgType.FREQUENCY_RANGE_SCAN_REQUEST, freq_range_scan,
+            num_freqs, scan_duration(num_freqs, rx_use, delay_ms) + timeout)
+
+        return ScanResult(frequencies, rssi_data[:num_freqs], rx_use)
+
+    async def rssi_scan_list(self, frequencies, rx_use=0,
+                             delay_ms=LIST_SCAN_DELAY_MS,
+                             timeout=1.0, address=None):
+        """Measure the RSSI for a list of frequencies
+
+        See TBSFusion.rssi_scan_list(). The response is awaited for the
+        approximate scan time plus timeout.
+        """
+        num_freqs = len(frequencies)
+        msg_data = list_scan_data(frequencies, rx_use, delay_ms)
+
+        rssi_data = await self._request(
+            address, MsgType.FREQUENCY_LIST_SCAN_REQUEST, msg_data,
+            num_freqs, scan_duration(num_freqs, rx_use, delay_ms) + timeout)
+
+        return ScanResult(array.array('H', frequencies),
+                          rssi_data[:num_freqs], rx_use)
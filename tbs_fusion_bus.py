@@ -0,0 +1,231 @@
+"""Share one serial port between several TBS Fusion receivers"""
+
+import collections
+import inspect
+import threading
+from concurrent.futures import Future
+
+from tbs_fusion import TBSFusion, sample_rssi
+
+
+class FusionBus:
+    """
+    Owns the serial port of a multi-drop RS-485 bus with one or more
+    TBS Fusion receivers on it.
+
+    Commands for all addresses are executed one at a time by a single
+    worker thread, so exchanges never overlap on the wire. Every address
+    has its own queue and the worker takes one command from each address
+    in turn, so a busy receiver (e.g. one running long scans) cannot
+    starve the others. Responses are matched to the request by the
+    address in the frame header.
+
+    Use FusionBus.acquire() to get the bus for a port and device() to
+    get a handle for one receiver on it.
+    """
+    _buses = {}
+    _buses_lock = threading.Lock()
+
+    def __init__(self, port, **kwargs):
+        """
+        Parameters
+        ----------
+        port : str
+            Serial port to use. E.g. 'COM1' or '/dev/ttyUSB0'.
+        **kwargs
+            Passed to TBSFusion().
+        """
+        self.port = port
+        self.fusion = TBSFusion(port, **kwargs)
+        # Trace recorder of the port, shared by all receivers on it
+        self.trace = kwargs.get('trace')
+        # Port settings later acquire() calls have to match
+        self._settings = self._port_settings(port, kwargs)
+
+        self._queues = collections.defaultdict(collections.deque)
+        # Addresses with queued commands, in the order they are served
+        self._ready = collections.deque()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._users = 0
+
+        self._worker = threading.Thread(target=self._run, daemon=True,
+                                        name='FusionBus %s' % port)
+        self._worker.start()
+
+    @classmethod
+    def acquire(cls, port, **kwargs):
+        """Get the bus for a port, opening the port on first use
+
+        Every call must be paired with a call to release().
+
+        The port is opened with the settings of the first call, later
+        calls must pass the same ones. Only whether there is a trace is
+        compared: the recorder of the first call is used for the whole
+        port, get it from the trace attribute of the bus.
+
+        Raises
+        ------
+        ValueError
+            If the port is already open with other settings.
+        """
+        with cls._buses_lock:
+            bus = cls._buses.get(port)
+            if bus is None:
+                bus = cls(port, **kwargs)
+                cls._buses[port] = bus
+            else:
+                settings = cls._port_settings(port, kwargs)
+                if settings != bus._settings:
+                    changed = sorted(name for name in settings
+                                     if settings[name] != bus._settings[name])
+                    raise ValueError(
+                        'Bus on %s is already open with other settings: %s'
+                        % (port, ', '.join(
+                            '%s=%r (open with %r)'
+                            % (name, settings[name], bus._settings[name])
+                            for name in changed)))
+            bus._users += 1
+            return bus
+
+    @staticmethod
+    def _port_settings(port, kwargs):
+        # TBSFusion() arguments with the defaults filled in, so passing
+        # a default explicitly does not count as a difference
+        bound = inspect.signature(TBSFusion).bind(port, **kwargs)
+        bound.apply_defaults()
+        settings = dict(bound.arguments)
+        del settings['port']
+        settings['trace'] = settings['trace'] is not None
+        return settings
+
+    def release(self):
+        """Release the bus, closing the port when the last user is gone"""
+        with self._buses_lock:
+            self._users -= 1
+            if self._users > 0:
+                return
+            if self._buses.get(self.port) is self:
+                del self._buses[self.port]
+        self.close()
+
+    def close(self):
+        """Stop the worker and close the port
+
+        Commands that are still queued fail with a RuntimeError.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._worker.join()
+
+        for queue in self._queues.values():
+            for future, _, _, _ in queue:
+                future.set_exception(RuntimeError('Bus closed'))
+        self._queues.clear()
+        self._ready.clear()
+        self.fusion.close()
+
+    def device(self, address):
+        """Get a handle for the receiver with the given address"""
+        return FusionDevice(self, address)
+
+    def submit(self, address, method, *args, **kwargs):
+        """Queue a TBSFusion call for the receiver at address
+
+        Parameters
+        ----------
+        address : int
+            Address of the TBS Fusion.
+        method : str
+            Name of the TBSFusion method, e.g. 'set_frequency'.
+        *args, **kwargs
+            Arguments of the method, without the address.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the return value of the method.
+        """
+        future = Future()
+        kwargs['address'] = address
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('Bus closed')
+            queue = self._queues[address]
+            if not queue:
+                self._ready.append(address)
+            queue.append((future, method, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def call(self, address, method, *args, **kwargs):
+        """Like submit(), but wait for and return the result"""
+        return self.submit(address, method, *args, **kwargs).result()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+                # Round robin over the addresses with queued commands
+                address = self._ready.popleft()
+                queue = self._queues[address]
+                future, method, args, kwargs = queue.popleft()
+                if queue:
+                    self._ready.append(address)
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = getattr(self.fusion, method)(*args, **kwargs)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+
+class FusionDevice:
+    """
+    Handle for one TBS Fusion on a FusionBus.
+
+    Has the same methods as TBSFusion, without the address parameter.
+    Calls block until the bus has executed them.
+    """
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+
+    def set_frequency(self, frequency):
+        """See TBSFusion.set_frequency()"""
+        return self.bus.call(self.address, 'set_frequency', frequency)
+
+    def get_frequency_rssi(self):
+        """See TBSFusion.get_frequency_rssi()"""
+        return self.bus.call(self.address, 'get_frequency_rssi')
+
+    def stream_rssi(self, rate=None, average=1, stop=None):
+        """See TBSFusion.stream_rssi()
+
+        Every reading is a separate bus call, so commands for this and
+        the other receivers on the bus are executed in between.
+        """
+        return sample_rssi(self.get_frequency_rssi, rate, average, stop)
+
+    def rssi_scan_range(self, freq_start, freq_stop, freq_step, **kwargs):
+        """See TBSFusion.rssi_scan_range()"""
+        return self.bus.call(self.address, 'rssi_scan_range', freq_start,
+                             freq_stop, freq_step, **kwargs)
+
+    def rssi_scan_list(self, frequencies, **kwargs):
+        """See TBSFusion.rssi_scan_list()"""
+        return self.bus.call(self.address, 'rssi_scan_list', frequencies,
+                             **kwargs)
+
+    def rssi_sweep(self, frequencies, **kwargs):
+        """See TBSFusion.rssi_sweep()"""
+        return self.bus.call(self.address, 'rssi_sweep', frequencies,
+                             **kwargs)
@@ -0,0 +1,338 @@
+"""Simulated TBS Fusion on a Linux pseudo-terminal
+
+Speaks the same framing as the real receiver, so TBSFusion (and
+Antenna_5_8) can be pointed at the printed port path for offline tests
+and benchmarks.
+
+Usage: python tbs_fusion_sim.py [options]
+"""
+
+import argparse
+import math
+import os
+import pty
+import random
+import select
+import struct
+import sys
+import threading
+import time
+import tty
+
+from tbs_fusion import (FrameEncoder, FrameParser, MsgType, scan_duration,
+                        ACK_PAYLOAD, FREQ_RSSI_PAYLOAD, SET_FREQ_PAYLOAD,
+                        RANGE_SCAN_PAYLOAD, LIST_SCAN_PAYLOAD)
+
+# Error codes sent in the ACK
+ERROR_NONE = 0
+ERROR_UNKNOWN_MSG = 1
+ERROR_INVALID_FREQUENCY = 2
+ERROR_INVALID_LENGTH = 3
+
+# Default per-command processing latency in seconds
+DEFAULT_LATENCY = {
+    MsgType.COMMAND_SET_FREQUENCY: 0.002,
+    MsgType.FREQUENCY_RSSI_REQUEST: 0.001,
+    MsgType.FREQUENCY_RANGE_SCAN_REQUEST: 0.001,
+    MsgType.FREQUENCY_LIST_SCAN_REQUEST: 0.001,
+}
+
+
+class SyntheticSpectrum:
+    """
+    RSSI of a few video transmitters on top of a noise floor.
+
+    Calling it with a frequency in MHz and the receiver (1: A, 2: B)
+    returns the raw RSSI, 0..255.
+    """
+    def __init__(self, transmitters=((5658, 200), (5800, 160), (5917, 120)),
+                 width=8.0, noise_floor=30, noise=4, seed=None):
+        """
+        Parameters
+        ----------
+        transmitters : sequence of (int, int)
+            Frequency in MHz and peak RSSI of each transmitter.
+        width : float
+            Width of a transmitter peak in MHz.
+        noise_floor : int
+            RSSI without a transmitter.
+        noise : int
+            Amplitude of the random noise added to every measurement.
+        seed : int or None
+            Seed of the noise generator.
+        """
+        self.transmitters = list(transmitters)
+        self.width = width
+        self.noise_floor = noise_floor
+        self.noise = noise
+        self._random = random.Random(seed)
+
+    def __call__(self, frequency, receiver):
+        rssi = self.noise_floor
+        for tx_frequency, peak in self.transmitters:
+            rssi += (peak - self.noise_floor) * math.exp(
+                -0.5 * ((frequency - tx_frequency) / self.width) ** 2)
+        # Receiver B is a bit less sensitive
+        if receiver == 2:
+            rssi *= 0.9
+        rssi += self._random.uniform(-self.noise, self.noise)
+        return max(0, min(255, int(rssi)))
+
+
+class FusionSimulator:
+    """
+    Simulated TBS Fusion receivers behind a pseudo-terminal.
+
+    Answers FREQUENCY_RSSI_REQUEST, COMMAND_SET_FREQUENCY and both scan
+    requests for each of its addresses. Responses are delayed by the
+    per-command latency and the scan time, and paced to the baudrate.
+    Faults can be injected at a configurable rate.
+    """
+    def __init__(self, addresses=(1,), baudrate=9600, spectrum=None,
+                 latency=None, pace=True, min_frequency=4900,
+                 max_frequency=6000, drop_rate=0.0, bad_crc_rate=0.0,
+                 wrong_address_rate=0.0, seed=None):
+        """
+        Parameters
+        ----------
+        addresses : sequence of int
+            Addresses of the simulated receivers on the bus.
+        baudrate : int
+            Baudrate used to pace the responses.
+        spectrum : callable or None
+            spectrum(frequency, receiver) returning the raw RSSI.
+            If None, a SyntheticSpectrum is used.
+        latency : dict or None
+            Processing time in seconds by MsgType, see DEFAULT_LATENCY.
+        pace : bool
+            Send responses no faster than the baudrate allows.
+        min_frequency, max_frequency : int
+            Frequencies in MHz outside this range are rejected with
+            ERROR_INVALID_FREQUENCY.
+        drop_rate : float
+            Probability that one random byte of a response is lost.
+        bad_crc_rate : float
+            Probability that a response is sent with a wrong CRC.
+        wrong_address_rate : float
+            Probability that a response is sent with a wrong address.
+        seed : int or None
+            Seed for the fault injection.
+        """
+        self.addresses = list(addresses)
+        self.baudrate = baudrate
+        self.spectrum = spectrum or SyntheticSpectrum(seed=seed)
+        self.latency = dict(DEFAULT_LATENCY)
+        if latency:
+            self.latency.update(latency)
+        self.pace = pace
+        self.min_frequency = min_frequency
+        self.max_frequency = max_frequency
+        self.drop_rate = drop_rate
+        self.bad_crc_rate = bad_crc_rate
+        self.wrong_address_rate = wrong_address_rate
+        self._random = random.Random(seed)
+        # Responses are built in a preallocated buffer
+        self._encoder = FrameEncoder()
+
+        self.frequencies = {address: min_frequency for address in addresses}
+
+        # Number of requests received and of faults injected
+        self.requests = 0
+        self.faults = 0
+
+        self.port = None
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        """Open the pseudo-terminal and start answering requests
+
+        Returns
+        -------
+        port : str
+            Path of the port to open, e.g. '/dev/pts/3'.
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='FusionSimulator')
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        """Stop answering and close the pseudo-terminal"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def _run(self):
+        parser = FrameParser()
+        while not self._stopped.is_set():
+            readable, _, _ = select.select([self._master], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                # Happens while no process has the port open
+                time.sleep(0.01)
+                continue
+
+            parser.feed(data)
+            for address, msg_type, msg_data in parser.frames():
+                if address in self.addresses:
+                    self.requests += 1
+                    self._handle(address, msg_type, bytes(msg_data))
+
+    def _handle(self, address, msg_type_value, msg_data):
+        try:
+            msg_type = MsgType(msg_type_value)
+        except ValueError:
+            self._ack(address, msg_type_value, ERROR_UNKNOWN_MSG)
+            return
+
+        time.sleep(self.latency.get(msg_type, 0))
+
+        if msg_type == MsgType.COMMAND_SET_FREQUENCY:
+            frequency, = SET_FREQ_PAYLOAD.unpack(msg_data)
+            if not self.min_frequency <= frequency <= self.max_frequency:
+                self._ack(address, msg_type.value, ERROR_INVALID_FREQUENCY)
+                return
+            self.frequencies[address] = frequency
+            self._ack(address, msg_type.value, ERROR_NONE)
+
+        elif msg_type == MsgType.FREQUENCY_RSSI_REQUEST:
+            frequency = self.frequencies[address]
+            self._send_struct(address, MsgType.FREQUENCY_RSSI_RESPONSE,
+                              FREQ_RSSI_PAYLOAD, frequency,
+                              self.spectrum(frequency, 1),
+                              self.spectrum(frequency, 2))
+
+        elif msg_type == MsgType.FREQUENCY_RANGE_SCAN_REQUEST:
+            freq_start, freq_stop, freq_step, rx_use, delay_ms = \
+                RANGE_SCAN_PAYLOAD.unpack(msg_data)
+            if freq_step == 0:
+                self._ack(address, msg_type.value, ERROR_INVALID_FREQUENCY)
+                return
+            self._scan(address, msg_type,
+                       range(freq_start, freq_stop, freq_step), rx_use,
+                       delay_ms)
+
+        elif msg_type == MsgType.FREQUENCY_LIST_SCAN_REQUEST:
+            num_freqs = (len(msg_data) - LIST_SCAN_PAYLOAD.size) // 2
+            rx_use, delay_ms = LIST_SCAN_PAYLOAD.unpack_from(msg_data)
+            frequencies = struct.unpack_from('<%dH' % num_freqs, msg_data,
+                                             LIST_SCAN_PAYLOAD.size)
+            self._scan(address, msg_type, frequencies, rx_use, delay_ms)
+
+        else:
+            self._ack(address, msg_type.value, ERROR_UNKNOWN_MSG)
+
+    def _scan(self, address, msg_type, frequencies, rx_use, delay_ms):
+        if len(frequencies) > 255:
+            self._ack(address, msg_type.value, ERROR_INVALID_LENGTH)
+            return
+
+        time.sleep(scan_duration(len(frequencies), rx_use, delay_ms))
+
+        rssi = bytearray(len(frequencies))
+        for i, frequency in enumerate(frequencies):
+            # With both receivers they take turns, A measures first
+            receiver = rx_use if rx_use else 1 + i % 2
+            rssi[i] = self.spectrum(frequency, receiver)
+        if frequencies:
+            self.frequencies[address] = frequencies[-1]
+
+        self._send(address, MsgType.FREQUENCY_SCAN_RESPONSE, rssi)
+
+    def _ack(self, address, msg_type_value, error_code):
+        self._send_struct(address, MsgType.ACK, ACK_PAYLOAD, msg_type_value,
+                          error_code)
+
+    def _send(self, address, msg_type, msg_data):
+        address = self._fault_address(address)
+        self._write(self._encoder.encode(address, msg_type, msg_data))
+
+    def _send_struct(self, address, msg_type, packer, *values):
+        address = self._fault_address(address)
+        self._write(self._encoder.encode_struct(address, msg_type, packer,
+                                                *values))
+
+    def _fault_address(self, address):
+        if self._random.random() < self.wrong_address_rate:
+            self.faults += 1
+            address = (address + 1) % 256
+        return address
+
+    def _write(self, tx_data):
+        # tx_data is a view into the encoder buffer, only valid until the
+        # next response is encoded, os.write() below is done with it by then
+        if self._random.random() < self.bad_crc_rate:
+            self.faults += 1
+            tx_data[2] ^= 0xFF
+        if self._random.random() < self.drop_rate:
+            self.faults += 1
+            tx_data = bytearray(tx_data)
+            del tx_data[self._random.randrange(len(tx_data))]
+
+        if self.pace:
+            # 10 bits per byte: start bit, 8 data bits, stop bit
+            time.sleep(10 * len(tx_data) / self.baudrate)
+        try:
+            os.write(self._master, tx_data)
+        except OSError:
+            pass
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Simulated TBS Fusion on a pseudo-terminal')
+    parser.add_argument('--address', type=int, action='append',
+                        help='receiver address, can be repeated (default 1)')
+    parser.add_argument('--baudrate', type=int, default=9600)
+    parser.add_argument('--no-pace', action='store_true',
+                        help='do not pace responses to the baudrate')
+    parser.add_argument('--drop-rate', type=float, default=0.0)
+    parser.add_argument('--bad-crc-rate', type=float, default=0.0)
+    parser.add_argument('--wrong-address-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv[1:])
+
+    simulator = FusionSimulator(addresses=args.address or [1],
+                                baudrate=args.baudrate,
+                                pace=not args.no_pace,
+                                drop_rate=args.drop_rate,
+                                bad_crc_rate=args.bad_crc_rate,
+                                wrong_address_rate=args.wrong_address_rate,
+                                seed=args.seed)
+    with simulator:
+        print('TBS Fusion simulator listening on %s' % simulator.port)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+    print('%d requests, %d faults injected'
+          % (simulator.requests, simulator.faults))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
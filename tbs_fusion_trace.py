@@ -0,0 +1,128 @@
+"""Record the TBS Fusion serial traffic and decode it offline
+
+Usage: python tbs_fusion_trace.py TRACE_FILE
+"""
+
+import collections
+import struct
+import sys
+import time
+
+TRACE_TX = 0
+TRACE_RX = 1
+
+_DIRECTION_NAMES = {TRACE_TX: 'TX', TRACE_RX: 'RX'}
+
+_FILE_MAGIC = b'TBSTRC01'
+# Timestamp in ns (monotonic clock), direction, data length
+_RECORD = struct.Struct('<QBH')
+
+
+class TraceRecorder:
+    """
+    In-memory ring buffer of the raw bytes sent to and received from
+    the TBS Fusion.
+
+    Recording only copies the data and takes a timestamp. Nothing is
+    formatted until the trace is dumped, so it can stay enabled in the
+    field. When the buffer is full the oldest records are dropped.
+    """
+    def __init__(self, capacity=4096):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Maximum number of records kept.
+        """
+        self._records = collections.deque(maxlen=capacity)
+
+    def __len__(self):
+        return len(self._records)
+
+    def record(self, direction, data):
+        """Record data sent (TRACE_TX) or received (TRACE_RX)"""
+        self._records.append((time.monotonic_ns(), direction, bytes(data)))
+
+    def records(self):
+        """List of (timestamp_ns, direction, data) tuples, oldest first"""
+        return list(self._records)
+
+    def clear(self):
+        self._records.clear()
+
+    def dump(self, path):
+        """Write the trace to a binary file, see read_trace()"""
+        with open(path, 'wb') as trace_file:
+            trace_file.write(_FILE_MAGIC)
+            for timestamp, direction, data in self.records():
+                trace_file.write(_RECORD.pack(timestamp, direction,
+                                              len(data)))
+                trace_file.write(data)
+
+
+def read_trace(path):
+    """Read a trace written by TraceRecorder.dump()
+
+    Returns
+    -------
+    records : list of tuple
+        (timestamp_ns, direction, data) tuples, oldest first.
+    """
+    with open(path, 'rb') as trace_file:
+        content = trace_file.read()
+
+    if not content.startswith(_FILE_MAGIC):
+        raise ValueError('%s is not a TBS Fusion trace file' % path)
+
+    records = []
+    offset = len(_FILE_MAGIC)
+    while offset < len(content):
+        timestamp, direction, length = _RECORD.unpack_from(content, offset)
+        offset += _RECORD.size
+        records.append((timestamp, direction,
+                        content[offset:offset + length]))
+        offset += length
+    return records
+
+
+def format_trace(records):
+    """Format trace records as text, one line per chunk and per frame
+
+    Every record is printed as hex. The frames found in each direction
+    are decoded and printed below the record they were completed in.
+    """
+    from tbs_fusion import FrameParser, MsgType
+
+    msg_type_names = {t.value: t.name for t in MsgType}
+    parsers = {TRACE_TX: FrameParser(), TRACE_RX: FrameParser()}
+
+    lines = []
+    t_start = records[0][0] if records else 0
+    for timestamp, direction, data in records:
+        lines.append('%12.6f %s %s'
+                     % (1e-9 * (timestamp - t_start),
+                        _DIRECTION_NAMES.get(direction, '??'),
+                        ' '.join('%02X' % x for x in data)))
+
+        parser = parsers.setdefault(direction, FrameParser())
+        parser.feed(data)
+        for address, msg_type, msg_data in parser.frames():
+            lines.append('%15s address: %d %s data: %s'
+                         % ('', address,
+                            msg_type_names.get(msg_type, msg_type),
+                            ' '.join('%02X' % x for x in msg_data)))
+    return lines
+
+
+def main(argv):
+    if len(argv) != 2:
+        print(__doc__.strip().splitlines()[-1])
+        return 1
+
+    for line in format_trace(read_trace(argv[1])):
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
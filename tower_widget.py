@@ -1,22 +1,25 @@
 # This Python file uses the following encoding: utf-8
 
 import sys
-from PySide6.QtWidgets import QApplication, QWidget, QHBoxLayout, QToolButton, QVBoxLayout, QLabel
+from PySide6.QtWidgets import QApplication, QWidget, QHBoxLayout, QToolButton, QVBoxLayout, QLabel, QComboBox
 from PySide6.QtGui import QPixmap, QIcon
 from PySide6.QtCore import Qt, Slot
 import json
 import widget_images
 from utility import loadQssFile
-from station_widget import StationWidget
+from station_widget import StationWidget, PartitionMode
 
 
 class MainWidget(QWidget):
 
     isStationMode = False # Always False for Tower widget
+    partitionModes = [PartitionMode.FullBand, PartitionMode.Interleaved, PartitionMode.Contiguous]
 
     def __init__(self, *arg, **kwargs):
         super().__init__(*arg, **kwargs)
 
+        self.partitionMode = PartitionMode.FullBand
+
         self.setStyleSheet(loadQssFile('widget_styles.qss'))
         self.setLayout(QHBoxLayout())
 
@@ -34,6 +37,8 @@ class MainWidget(QWidget):
                 self.stationsWidgets[i] = station
 
                 station.syncWithCurrentStation.connect(self.setFrequencyForAllStationsOfSameType)
+                station.iteratorToggled.connect(self.rebalanceStations)
+                station.remoteModeChanged.connect(self.rebalanceStations)
                 self.layout().addWidget(station)
 
         stopAllLayout = QVBoxLayout(spacing=10, alignment=Qt.AlignVCenter)
@@ -42,8 +47,17 @@ class MainWidget(QWidget):
         self.stopAllButton.setIcon(QIcon(QPixmap(':/img/stop.png')))
         self.stopAllButton.clicked.connect(self.stopAllStations)
 
+        self.partitionModeList = QComboBox(
+            objectName='partitionModeList',
+            toolTip='Split each band among its active stations'
+        )
+        self.partitionModeList.addItems(self.partitionModes)
+        self.partitionModeList.currentTextChanged.connect(self.setPartitionMode)
+
         stopAllLayout.addWidget(self.stopAllButton)
         stopAllLayout.addWidget(QLabel('Stop All'))
+        stopAllLayout.addWidget(QLabel('Coverage'))
+        stopAllLayout.addWidget(self.partitionModeList)
 
         self.layout().addLayout(stopAllLayout)
 
@@ -52,6 +66,30 @@ class MainWidget(QWidget):
     def stopAllStations(self):
         for station in self.stationsWidgets:
             station.stopStation.emit()
+        self.rebalanceStations()
+
+
+    @Slot(str)
+    def setPartitionMode(self, mode):
+        self.partitionMode = mode
+        self.rebalanceStations()
+
+
+    @Slot()
+    def rebalanceStations(self):
+        # Give every active station of a band its own slice, so together
+        # they cover the band once instead of each doing all of it
+        stationsByPreset = {}
+        for station in self.stationsWidgets:
+            if station.isIteratorCoordinated():
+                stationsByPreset.setdefault(station.currentPreset['name'], []).append(station)
+
+        for station in self.stationsWidgets:
+            stations = stationsByPreset.get(station.currentPreset['name'], [])
+            if self.partitionMode == PartitionMode.FullBand or len(stations) < 2 or station not in stations:
+                station.setPartition(None)
+            else:
+                station.setPartition((stations.index(station), len(stations), self.partitionMode))
 
 
     @Slot(str, str)
@@ -30,6 +30,11 @@ class MainWidget(QWidget):
             self.layout().addWidget(station)
 
 
+    def closeEvent(self, event):
+        self.stationWidget.closeAntenna()
+        super().closeEvent(event)
+
+
 def main():
     app = QApplication(sys.argv)
 